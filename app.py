@@ -38,19 +38,50 @@ This advanced version combines **multiple prompting strategies** for superior pe
 
 import os
 import re
-import torch
-import faiss
+import sys
+import importlib
+import subprocess
+import copy
+import queue
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import shutil
+import hashlib
+import time
+import multiprocessing
+import sqlite3
 import numpy as np
-import gradio as gr
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline, BitsAndBytesConfig
-from sentence_transformers import SentenceTransformer
 from pypdf import PdfReader
+from pdf_extract import extract_page_range
 import warnings
 from typing import Dict, List, Tuple, Optional
 import json
 from dataclasses import dataclass
-from collections import Counter
-import plotly.graph_objects as go
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from functools import lru_cache, wraps
+from contextlib import nullcontext
+
+class _LazyModule:
+    """Module proxy that performs the real import when an attribute is first used."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+# Heavy ML libraries are imported on first use, so the UI starts without them
+torch = _LazyModule("torch")
+faiss = _LazyModule("faiss")
+transformers = _LazyModule("transformers")
+sentence_transformers = _LazyModule("sentence_transformers")
+go = _LazyModule("plotly.graph_objects")
+gr = _LazyModule("gradio")  # Only needed once build_demo() runs, not in spawned PDF workers
 
 warnings.filterwarnings("ignore", category=FutureWarning)
 
@@ -59,18 +90,93 @@ print("Libraries imported successfully.")
 """### ⚙️ Part 2: Configuration with Example Library"""
 
 # --- Configuration ---
-if torch.cuda.is_available():
-    device = torch.device("cuda")
-    print(f"Using GPU: {torch.cuda.get_device_name(0)}")
-else:
-    device = torch.device("cpu")
+def select_device():
+    """Picks the GPU when available (imports torch, so it runs at model load)."""
+    if torch.cuda.is_available():
+        print(f"Using GPU: {torch.cuda.get_device_name(0)}")
+        return torch.device("cuda")
     print("Using CPU. Note: LLM inference will be significantly slower.")
+    return torch.device("cpu")
 
 # --- Model Selection ---
 EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+EMBEDDING_BACKEND = "torch"  # "torch" (sentence-transformers) or "onnx" (ONNX Runtime, CPU)
+EMBEDDING_ONNX_QUANTIZE = True  # Dynamic int8 quantization of the exported ONNX model
+EMBEDDING_ONNX_DIR = "onnx_models"  # Exported models, reused across restarts
 LLM_MODEL_NAME = "google/gemma-2b-it"
 TARGET_LANGUAGE = "Finnish"
 
+# --- Serving ---
+WARMUP_ENABLED = True  # Run a dummy embedding and generation before reporting ready
+WARMUP_MAX_NEW_TOKENS = 8
+HEALTH_PORT = 7861  # /health and /ready probes for the load balancer; None disables
+GENERATION_MAX_BATCH_SIZE = 8  # Concurrent prompts generated together in one pipeline call
+GENERATION_MAX_WAIT_MS = 20  # How long the first queued prompt waits for others to join its batch
+SELF_CONSISTENCY_TEMPERATURE = 0.8  # Shared by all samples, which are drawn in one batched call
+GENERATION_DEFAULTS = {
+    "max_new_tokens": 500,  # Increased for complex strategies
+    "temperature": 0.7,
+    "top_p": 0.9,
+    "do_sample": True,
+}
+STRATEGY_MAX_NEW_TOKENS = {  # Budgets per strategy; reasoning strategies need room for their steps
+    "standard": 256,
+    "few_shot": 256,
+    "chain_of_thought": 448,
+    "combined": 500,
+}
+STOP_MARKERS = ("\nQUESTION:", "\nCONTEXT:", "\nQ:", "\nExample ")  # Invented continuations past the answer
+STOP_MARKER_WINDOW = 16  # Trailing tokens decoded at each step to look for a marker
+RESPONSE_CACHE_SIZE = 256  # Generated responses kept; 0 disables the response cache
+RESPONSE_CACHE_TTL = 3600  # Seconds before a cached response is regenerated; None keeps it until evicted
+RESPONSE_CACHE_SAMPLED = True  # Also reuse sampled (non-deterministic) generations; False always resamples
+RESPONSE_CACHE_PATH = None  # e.g. os.path.join(VECTOR_STORE_DIR, "responses.json") to keep responses across restarts
+PREFIX_CACHE_ENABLED = True  # Reuse the prefill of role/strategy/example prompt headers
+PREFIX_CACHE_SIZE = 32  # Headers whose key/values are kept
+STREAM_RESPONSES = True  # Push tokens to the Analyze tab as they are generated
+
+# --- Document Processing ---
+CHUNK_TOKEN_BUDGET = 200  # Max embedder tokens per chunk (all-MiniLM-L6-v2 truncates at 256)
+CHUNK_OVERLAP_SENTENCES = 1  # Trailing sentences repeated at the start of the next chunk
+TOKEN_COUNT_CACHE_SIZE = 65_536  # Sentences/words whose token counts are memoized
+DEDUP_CHUNKS = True  # Drop exact and near-duplicate chunks (repeated headers, boilerplate) before embedding
+SIMHASH_MAX_DISTANCE = 3  # Max differing bits (of 64) for two chunks to count as near-duplicates
+SIMHASH_SHINGLE_SIZE = 3  # Words per shingle hashed into the SimHash fingerprint
+MIN_CHUNK_CHARS = 50
+EMBEDDING_BATCH_SIZE = 128  # Upper bound on chunks per encode call
+EMBEDDING_BATCH_TOKENS = 8192  # Padded tokens per encode call; batches of short chunks grow up to EMBEDDING_BATCH_SIZE
+EMBEDDING_SORT_WINDOW = 512  # Chunks buffered from the PDF stream and sorted by length before batching
+EMBEDDING_THREADS = None  # Torch CPU threads for encoding; None keeps the torch default
+PDF_EXTRACT_WORKERS = 1  # >1 extracts page shards in a process pool; None uses every CPU core
+PDF_PAGES_PER_SHARD = 16
+VECTOR_STORE_DIR = "vector_store_cache"  # Persisted indexes, keyed by document content hash
+EMBEDDING_CACHE_ENABLED = True  # Reuse embeddings of chunk text seen in any earlier document
+EMBEDDING_CACHE_PATH = os.path.join(VECTOR_STORE_DIR, "embeddings.sqlite")
+EMBEDDING_CACHE_MAX_MB = 512  # Least recently used embeddings are evicted beyond this size
+
+# --- Vector Search ---
+VECTOR_INDEX_TYPE = "auto"  # "flat", "ivf_flat", "ivf_pq", "hnsw", or "auto" to choose by corpus size
+FLAT_INDEX_MAX_VECTORS = 50_000  # auto: exact search below this size
+IVF_PQ_MIN_VECTORS = 1_000_000  # auto: compressed IVF-PQ from this size on
+ANN_MIN_TRAIN_VECTORS = 10_000  # Fewer vectors than this always use a flat index
+FAISS_TRAIN_SAMPLE = 100_000  # Vectors sampled to train IVF centroids and PQ codebooks
+FAISS_NPROBE = 16  # IVF lists scanned per query
+FAISS_EF_SEARCH = 64  # HNSW candidate list size per query
+HNSW_M = 32
+VECTOR_METRIC = "l2"  # "l2", or "cosine" to L2-normalize once at index time and search by inner product
+VECTOR_STORAGE = "float32"  # "float32", "float16" or "sq8" (8-bit scalar quantization); ignored by ivf_pq
+QUERY_CACHE_SIZE = 1024  # Query embeddings kept in the LRU cache
+QUERY_BATCH_SIZE = 256  # Queries encoded per batch by retrieve_batch
+RETRIEVAL_TOP_K = 3  # Upper bound on chunks put into the prompt
+RETRIEVAL_MIN_SCORE = 0.0  # Drop chunks scoring below this (see distance_to_score)
+RETRIEVAL_ADAPTIVE_RATIO = 0.0  # >0 keeps only chunks scoring at least this fraction of the best one
+HYBRID_SEARCH = True  # Fuse BM25 keyword ranking with dense search
+HYBRID_CANDIDATES = 20  # Candidates taken from each ranking before fusion
+RRF_K = 60  # Reciprocal rank fusion damping constant
+HYBRID_BM25_MIN_RATIO = 0.1  # BM25 candidates below this fraction of the top BM25 score are not fused
+BM25_K1 = 1.5
+BM25_B = 0.75
+
 # ---Role Definitions with Examples ---
 @dataclass
 class RoleConfig:
@@ -142,7 +248,15 @@ STRATEGIES = {
 # --- Global Variables ---
 embedder = None
 text_generator = None
+prefix_cache = None
+generation_scheduler = None
 tokenizer = None
+device = None
+model_state = {"status": "not loaded", "error": None, "load_seconds": None, "warmup_ms": None}
+_embedder_loaded = threading.Event()  # Set once the embedder load finished (or failed)
+_llm_loaded = threading.Event()
+_model_loader = None
+_model_loader_lock = threading.Lock()
 
 """### 🔑 Part 3: Authenticate with Hugging Face Hub"""
 
@@ -150,25 +264,157 @@ tokenizer = None
 
 """### 🤖 Part 4: Load Models"""
 
+class OnnxEmbedder:
+    """CPU embedder running a sentence-transformers model through ONNX Runtime.
+
+    The transformer is exported to ONNX once (optionally int8-quantized) and
+    cached in EMBEDDING_ONNX_DIR; mean pooling and normalization are done in
+    numpy to match the original pipeline. Exposes the subset of the
+    SentenceTransformer interface the app uses (encode, tokenizer,
+    max_seq_length), plus a name that keeps its vectors apart in caches.
+    """
+
+    def __init__(self, source_model, quantize: bool = EMBEDDING_ONNX_QUANTIZE,
+                 model_dir: str = EMBEDDING_ONNX_DIR, threads: Optional[int] = EMBEDDING_THREADS):
+        import onnxruntime  # Optional dependency, only needed for this backend
+
+        pooling = source_model[1]
+        if not getattr(pooling, "pooling_mode_mean_tokens", False):
+            raise ValueError("OnnxEmbedder only supports mean-pooled models")
+        self.tokenizer = source_model.tokenizer
+        self.max_seq_length = source_model.max_seq_length
+        self.normalize = any(type(module).__name__ == "Normalize" for module in source_model)
+        self.name = f"{EMBEDDING_MODEL_NAME}-onnx" + ("-int8" if quantize else "")
+
+        self.model_path = os.path.join(model_dir, self.name.replace("/", "_") + ".onnx")
+        if not os.path.exists(self.model_path):
+            self._export(source_model, quantize)
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads or 0
+        self.session = onnxruntime.InferenceSession(self.model_path, options,
+                                                    providers=["CPUExecutionProvider"])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+
+    def _export(self, source_model, quantize):
+        os.makedirs(os.path.dirname(self.model_path) or ".", exist_ok=True)
+        transformer = source_model[0].auto_model.cpu().eval()
+        sample = self.tokenizer(["Export sample sentence."], return_tensors="pt")
+        input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+
+        class _LastHiddenState(torch.nn.Module):
+            def __init__(self, model):
+                super().__init__()
+                self.model = model
+
+            def forward(self, *inputs):
+                return self.model(**dict(zip(input_names, inputs)))[0]
+
+        export_path = self.model_path + ".fp32" if quantize else self.model_path
+        with torch.no_grad():
+            torch.onnx.export(
+                _LastHiddenState(transformer), tuple(sample[name] for name in input_names), export_path,
+                input_names=input_names, output_names=["last_hidden_state"],
+                dynamic_axes={name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]},
+                opset_version=14,
+            )
+        if quantize:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            quantize_dynamic(export_path, self.model_path, weight_type=QuantType.QInt8)
+            os.remove(export_path)
+        print(f"Exported embedding model to {self.model_path}")
+
+    def encode(self, sentences, batch_size: int = 32, convert_to_tensor: bool = False,
+               show_progress_bar: bool = False, **kwargs):
+        """Same contract as SentenceTransformer.encode for the arguments the app passes."""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            encoded = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=True,
+                                     max_length=self.max_seq_length, return_tensors="np")
+            hidden = self.session.run(None, {name: encoded[name].astype('int64') for name in self.input_names})[0]
+            mask = encoded["attention_mask"][..., None].astype('float32')
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if self.normalize:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            batches.append(pooled.astype('float32'))
+        embeddings = np.concatenate(batches) if batches else np.empty((0, 0), dtype='float32')
+        if convert_to_tensor:
+            embeddings = torch.from_numpy(embeddings)
+        return embeddings[0] if single else embeddings
+
+def embedder_name(embedder_model=None) -> str:
+    """Identifies the embedding model and backend in caches and persisted stores."""
+    return getattr(embedder_model or embedder, "name", None) or EMBEDDING_MODEL_NAME
+
+def check_onnx_parity(texts, torch_model=None, onnx_model=None, min_cosine=0.99) -> Dict:
+    """Compares ONNX and PyTorch embeddings of texts by cosine similarity."""
+    torch_model = torch_model or sentence_transformers.SentenceTransformer(EMBEDDING_MODEL_NAME, device="cpu")
+    onnx_model = onnx_model or OnnxEmbedder(torch_model)
+    reference = np.asarray(torch_model.encode(texts, convert_to_tensor=False), dtype='float32')
+    candidate = np.asarray(onnx_model.encode(texts), dtype='float32')
+    cosine = np.sum(reference * candidate, axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1))
+    result = {"min_cosine": float(cosine.min()), "mean_cosine": float(cosine.mean()),
+              "passed": bool(cosine.min() >= min_cosine)}
+    print(f"ONNX parity ({onnx_model.name}): min cosine {result['min_cosine']:.4f}, "
+          f"mean {result['mean_cosine']:.4f} -> {'OK' if result['passed'] else 'FAILED'}")
+    return result
+
+def benchmark_embedding_backends(texts, batch_size=EMBEDDING_BATCH_SIZE):
+    """Reports CPU throughput and model size of the PyTorch and ONNX (fp32/int8) embedders."""
+    torch_model = sentence_transformers.SentenceTransformer(EMBEDDING_MODEL_NAME, device="cpu")
+    backends = [("torch", torch_model,
+                 sum(p.numel() * p.element_size() for p in torch_model.parameters()))]
+    for quantize in (False, True):
+        model = OnnxEmbedder(torch_model, quantize=quantize)
+        backends.append((model.name, model, os.path.getsize(model.model_path)))
+
+    results = []
+    for label, model, model_bytes in backends:
+        model.encode(texts[:batch_size], batch_size=batch_size)  # Warm up
+        start = time.perf_counter()
+        model.encode(texts, batch_size=batch_size)
+        chunks_per_sec = len(texts) / (time.perf_counter() - start)
+        print(f"{label:<32} {chunks_per_sec:9.1f} chunks/sec  {model_bytes / 1e6:7.1f} MB")
+        results.append({"backend": label, "chunks_per_sec": chunks_per_sec, "model_mb": model_bytes / 1e6})
+    for model in backends[1:]:
+        check_onnx_parity(texts[:256], torch_model, model[1])
+    return results
+
 def load_models():
     """Loads the embedding and language models."""
-    global embedder, text_generator, tokenizer
+    global embedder, text_generator, prefix_cache, generation_scheduler, tokenizer, device
 
+    device = select_device()
+    model_state["status"] = "loading embedder"
     print(f"Loading embedding model: {EMBEDDING_MODEL_NAME}...")
+    if EMBEDDING_THREADS and device.type == "cpu":
+        torch.set_num_threads(EMBEDDING_THREADS)
     try:
-        embedder = SentenceTransformer(EMBEDDING_MODEL_NAME, device=device)
+        embedder = sentence_transformers.SentenceTransformer(EMBEDDING_MODEL_NAME, device=device)
         print("Embedding model loaded successfully.")
     except Exception as e:
         print(f"Error loading embedding model: {e}")
         raise
 
+    if EMBEDDING_BACKEND == "onnx":
+        try:
+            embedder = OnnxEmbedder(embedder)
+            print(f"Using ONNX Runtime embedding backend ({embedder.name}).")
+        except Exception as e:
+            print(f"Could not set up ONNX embedding backend, using PyTorch: {e}")
+    _embedder_loaded.set()
+
+    model_state["status"] = "loading llm"
     print(f"Loading LLM: {LLM_MODEL_NAME}...")
     try:
         use_4bit = True
         bnb_config = None
         if use_4bit and torch.cuda.is_available():
             try:
-                bnb_config = BitsAndBytesConfig(
+                bnb_config = transformers.BitsAndBytesConfig(
                     load_in_4bit=True,
                     bnb_4bit_quant_type="nf4",
                     bnb_4bit_compute_dtype=torch.bfloat16,
@@ -179,14 +425,15 @@ def load_models():
                 print(f"Could not set up 4-bit quantization: {e}")
                 bnb_config = None
 
-        tokenizer = AutoTokenizer.from_pretrained(LLM_MODEL_NAME)
+        tokenizer = transformers.AutoTokenizer.from_pretrained(LLM_MODEL_NAME)
+        tokenizer.padding_side = "left"  # Decoder-only models generate after the prompt, so pad before it
 
         if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
              model_dtype = torch.bfloat16
         else:
              model_dtype = torch.float16
 
-        model = AutoModelForCausalLM.from_pretrained(
+        model = transformers.AutoModelForCausalLM.from_pretrained(
             LLM_MODEL_NAME,
             device_map="auto",
             torch_dtype=model_dtype,
@@ -195,104 +442,1679 @@ def load_models():
         )
         print("LLM loaded successfully.")
 
-        text_generator = pipeline(
+        text_generator = transformers.pipeline(
             "text-generation",
             model=model,
             tokenizer=tokenizer,
-            max_new_tokens=500,  # Increased for complex strategies
-            temperature=0.7,
-            top_p=0.9,
-            do_sample=True,
-            framework="pt"
+            framework="pt",
+            return_full_text=False,  # Callers get only the new text, never the echoed prompt
+            **GENERATION_DEFAULTS
         )
+        generator = DirectGenerator(model, tokenizer)
+        prefix_cache = PrefixKVCache(generator) if PREFIX_CACHE_ENABLED else None
+        generation_scheduler = GenerationScheduler(prefix_cache or generator)
         print("Text generation pipeline ready.")
 
     except Exception as e:
         print(f"Error loading LLM: {e}")
         raise
 
-# Load models
-try:
-    load_models()
-except Exception as e:
-    print(f"Failed to load models. Error: {e}")
+def warm_up_models() -> Dict[str, float]:
+    """Runs a short embedding and generation so the first user skips kernel/allocator warm-up.
+
+    The models are called directly, bypassing the embedding and query caches.
+    Returns the latency of each step in milliseconds.
+    """
+    timings = {}
+    start = time.perf_counter()
+    embedder.encode(["Warm-up sentence.", "A longer warm-up passage so batches with padding are exercised too."],
+                    convert_to_tensor=False, show_progress_bar=False)
+    timings["embedding_ms"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    text_generator("Hello", max_new_tokens=WARMUP_MAX_NEW_TOKENS, do_sample=False)
+    timings["generation_ms"] = (time.perf_counter() - start) * 1000
+    print(f"Warm-up: embedding {timings['embedding_ms']:.0f} ms, generation {timings['generation_ms']:.0f} ms")
+    return timings
+
+def _load_models_in_background():
+    start = time.perf_counter()
+    try:
+        load_models()
+        model_state["load_seconds"] = time.perf_counter() - start
+        if WARMUP_ENABLED:
+            model_state["status"] = "warming up"
+            model_state["warmup_ms"] = warm_up_models()
+        model_state["status"] = "ready"
+        print(f"Models ready in {time.perf_counter() - start:.1f}s.")
+    except Exception as e:
+        model_state.update(status="failed", error=str(e))
+        print(f"Failed to load models. Error: {e}")
+    finally:
+        _embedder_loaded.set()
+        _llm_loaded.set()
+
+def start_model_loading():
+    """Starts loading the models on a background thread (once)."""
+    global _model_loader
+    with _model_loader_lock:
+        if _model_loader is None:
+            _model_loader = threading.Thread(target=_load_models_in_background,
+                                             name="model-loader", daemon=True)
+            _model_loader.start()
+
+def ensure_models_loaded(need_llm: bool = True, timeout: Optional[float] = None) -> Optional[str]:
+    """Waits for the models a handler needs, starting the load on first use.
+
+    Document processing only needs the embedder, so it can run while the
+    LLM is still loading. Returns an error message, or None when ready.
+    """
+    start_model_loading()
+    (_llm_loaded if need_llm else _embedder_loaded).wait(timeout)
+    if embedder is None or (need_llm and text_generator is None):
+        if model_state["error"]:
+            return f"Models not loaded: {model_state['error']}"
+        return "Models are still loading, please try again shortly."
+    return None
+
+def model_status_message() -> str:
+    """Readiness line shown in the UI."""
+    status = model_state["status"]
+    if status == "ready":
+        return f"✅ Models ready ({embedder_name()}, {LLM_MODEL_NAME})"
+    if status == "failed":
+        return f"❌ Model loading failed: {model_state['error']}"
+    if status == "warming up":
+        return "⏳ Warming up models..."
+    if status == "loading llm":
+        return f"⏳ Loading {LLM_MODEL_NAME}... documents can already be processed."
+    if status == "loading embedder":
+        return f"⏳ Loading {EMBEDDING_MODEL_NAME}..."
+    return "💤 Models load in the background on first use."
+
+class _HealthHandler(BaseHTTPRequestHandler):
+    """/health always answers (liveness); /ready answers 200 only once models are warm."""
+
+    def do_GET(self):
+        if self.path not in ("/health", "/ready"):
+            self.send_error(404)
+            return
+        ready = model_state["status"] == "ready"
+        body = json.dumps({**model_state, "ready": ready}).encode("utf-8")
+        self.send_response(200 if ready or self.path == "/health" else 503)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Probes arrive every few seconds; keep them out of the console
+
+def start_health_server(port: int = HEALTH_PORT):
+    """Serves the readiness probes on a daemon thread, separate from the Gradio app."""
+    server = ThreadingHTTPServer(("0.0.0.0", port), _HealthHandler)
+    threading.Thread(target=server.serve_forever, name="health-server", daemon=True).start()
+    print(f"Health probes on http://0.0.0.0:{port}/health and /ready")
+    return server
+
+def profile_startup(modules=("numpy", "gradio", "pypdf", "faiss", "plotly.graph_objects",
+                             "torch", "transformers", "sentence_transformers")):
+    """Import-time profile: cold import of the app vs each dependency, in fresh interpreters.
+
+    For a per-module breakdown run: python -X importtime -c "import app"
+    """
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for module in (*modules, "app"):
+        code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+        output = subprocess.run([sys.executable, "-c", code], cwd=app_dir,
+                                capture_output=True, text=True)
+        if output.returncode != 0:
+            print(f"{module:<24} import failed")
+            continue
+        results[module] = float(output.stdout.strip().splitlines()[-1])
+        print(f"{module:<24} {results[module]:7.2f} s")
+    return results
 
 """### 📄 Part 5: Document Processing (Same as before)"""
 
-def load_and_chunk_pdf(file_path, chunk_size=700, chunk_overlap=70):
+def iter_pdf_pages(file_path, workers=PDF_EXTRACT_WORKERS, pages_per_shard=PDF_PAGES_PER_SHARD):
+    """Yields (page_number, text) for each PDF page, in page order.
+
+    With workers > 1, page ranges are extracted in a process pool; at most two
+    shards per worker are in flight so memory stays bounded on huge files.
+    Workers are spawned rather than forked, because by then this process
+    runs Gradio, model-loading and scheduler threads. A spawned worker
+    re-imports this script as __mp_main__, which is cheap: the UI, models
+    and response cache are only set up by main().
+    """
+    reader = PdfReader(file_path)
+    num_pages = len(reader.pages)
+    workers = workers or os.cpu_count() or 1
+
+    if workers <= 1 or num_pages <= pages_per_shard:
+        for page_number, page in enumerate(reader.pages):
+            page_text = page.extract_text()
+            if page_text:
+                yield page_number, page_text
+        return
+
+    shards = [(file_path, start, min(start + pages_per_shard, num_pages))
+              for start in range(0, num_pages, pages_per_shard)]
+    executor = ProcessPoolExecutor(max_workers=min(workers, len(shards)),
+                                   mp_context=multiprocessing.get_context("spawn"))
+    pending = deque()
+    try:
+        for shard in shards:
+            pending.append(executor.submit(extract_page_range, shard))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+def normalize_text(text):
+    """Collapses every whitespace run (including blank lines) into one space."""
+    return re.sub(r'\s+', ' ', text).strip()
+
+class TokenCounter:
+    """Counts tokens with a Hugging Face tokenizer, memoizing repeated strings.
+
+    Without a tokenizer (models not loaded yet) it falls back to a rough
+    four-characters-per-token estimate.
+    """
+
+    def __init__(self, tokenizer=None, cache_size=TOKEN_COUNT_CACHE_SIZE):
+        self.tokenizer = tokenizer
+        self.count = lru_cache(maxsize=cache_size)(self._count)
+
+    def _count(self, text: str) -> int:
+        if self.tokenizer is None:
+            return len(text) // 4 + 1
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def count_many(self, texts: List[str]) -> List[int]:
+        """Counts many texts in one tokenizer call, without memoizing them.
+
+        For strings that rarely repeat (whole chunks), which would only push
+        the sentence counts out of the cache.
+        """
+        if self.tokenizer is None:
+            return [len(text) // 4 + 1 for text in texts]
+        return [len(ids) for ids in self.tokenizer(list(texts), add_special_tokens=False)["input_ids"]]
+
+_token_counters = {}
+
+def get_token_counter(embedder_model=None):
+    """Token counter for the embedder's tokenizer, shared so its cache is reused."""
+    embedder_model = embedder_model or embedder
+    tokenizer = getattr(embedder_model, "tokenizer", None)
+    if id(tokenizer) not in _token_counters:
+        _token_counters[id(tokenizer)] = TokenCounter(tokenizer)
+    return _token_counters[id(tokenizer)]
+
+def chunk_token_budget(embedder_model=None, max_tokens=CHUNK_TOKEN_BUDGET):
+    """Caps the chunk budget below the embedder's limit ([CLS]/[SEP] included)."""
+    max_seq_length = getattr(embedder_model or embedder, "max_seq_length", None)
+    if max_seq_length:
+        return min(max_tokens, max_seq_length - 2)
+    return max_tokens
+
+_SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?…])\s+|(?<=[.!?…]["\')\]”’])\s+')
+_SENTENCE_END = re.compile(r'[.!?…]["\')\]”’]?$')
+
+def _split_sentence_spans(text, offset):
+    """(start, end) document offsets of each sentence in text starting at offset."""
+    spans = []
+    start = 0
+    for boundary in _SENTENCE_BOUNDARY.finditer(text):
+        spans.append((offset + start, offset + boundary.start()))
+        start = boundary.end()
+    if start < len(text):
+        spans.append((offset + start, offset + len(text)))
+    return spans
+
+def _split_long_sentence(text, offset, max_tokens, count_tokens):
+    """Splits a sentence longer than max_tokens at word boundaries."""
+    pieces = []
+    piece_start = None
+    piece_tokens = 0
+    for word in re.finditer(r'\S+', text):
+        word_tokens = count_tokens(word.group())
+        if piece_start is not None and piece_tokens + word_tokens > max_tokens:
+            pieces.append((offset + piece_start, offset + piece_end))
+            piece_start = None
+            piece_tokens = 0
+        if piece_start is None:
+            piece_start = word.start()
+        piece_end = word.end()
+        piece_tokens += word_tokens
+    if piece_start is not None:
+        pieces.append((offset + piece_start, offset + piece_end))
+    return pieces
+
+def iter_sentence_chunks(pages, max_tokens=None, overlap_sentences=CHUNK_OVERLAP_SENTENCES,
+                         token_counter=None):
+    """Packs whole sentences from (page_number, text) pairs into token-bounded chunks.
+
+    Yields (chunk, (start, end)) where the offsets index into the normalized
+    document (pages joined by single spaces). Token counts come from the
+    embedder's tokenizer, so no chunk is truncated at embedding time.
+    Chunks end at page breaks (a sentence cut by the break moves to the next
+    page), which keeps an edit on one page from reshaping the rest.
+    """
+    max_tokens = max_tokens or chunk_token_budget()
+    token_counter = token_counter or get_token_counter()
+    count_tokens = token_counter.count
+
+    document_length = 0
+    carry = ""  # Unfinished sentence from the previous page
+    carry_offset = 0
+
+    def pack(text, offset):
+        sentences = []  # (start, end, tokens) of the chunk being built
+        tokens = 0
+        for start, end in _split_sentence_spans(text, offset):
+            sentence_tokens = count_tokens(text[start - offset:end - offset])
+            if sentence_tokens > max_tokens:
+                if sentences:
+                    yield sentences
+                sentences, tokens = [], 0
+                for piece in _split_long_sentence(text[start - offset:end - offset], start,
+                                                  max_tokens, count_tokens):
+                    yield [(piece[0], piece[1], max_tokens)]
+                continue
+
+            if sentences and tokens + sentence_tokens > max_tokens:
+                yield sentences
+                sentences = sentences[-overlap_sentences:] if overlap_sentences else []
+                tokens = sum(t for _, _, t in sentences)
+                while sentences and tokens + sentence_tokens > max_tokens:
+                    tokens -= sentences.pop(0)[2]
+            sentences.append((start, end, sentence_tokens))
+            tokens += sentence_tokens
+        if sentences:
+            yield sentences
+
+    def emit(text, offset):
+        for sentences in pack(text, offset):
+            start, end = sentences[0][0], sentences[-1][1]
+            yield text[start - offset:end - offset], (start, end)
+
+    for _, page_text in pages:
+        page_text = normalize_text(page_text)
+        if not page_text:
+            continue
+        page_offset = document_length + 1 if document_length else 0
+        document_length = page_offset + len(page_text)
+
+        text = f"{carry} {page_text}" if carry else page_text
+        offset = carry_offset if carry else page_offset
+
+        # Hold back a trailing sentence fragment until the next page completes it
+        spans = _split_sentence_spans(text, offset)
+        carry = ""
+        if len(spans) > 1 and not _SENTENCE_END.search(text):
+            carry_offset = spans[-1][0]
+            carry = text[carry_offset - offset:]
+            text = text[:carry_offset - offset].rstrip()
+        if text:
+            yield from emit(text, offset)
+
+    if carry:
+        yield from emit(carry, carry_offset)
+
+def iter_pdf_chunks(file_path, max_tokens=None, overlap_sentences=CHUNK_OVERLAP_SENTENCES):
+    """Streams (chunk, (start, end)) pairs from a PDF while later pages are still unread."""
+    for chunk, span in iter_sentence_chunks(iter_pdf_pages(file_path), max_tokens, overlap_sentences):
+        if len(chunk.strip()) > MIN_CHUNK_CHARS:
+            yield chunk, span
+
+def _hash64(text):
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+def simhash(text, shingle_size=SIMHASH_SHINGLE_SIZE):
+    """64-bit SimHash fingerprint over word shingles; similar texts differ in few bits."""
+    words = text.lower().split()
+    shingles = {" ".join(words[i:i + shingle_size])
+                for i in range(max(1, len(words) - shingle_size + 1))}
+    hashes = np.fromiter((_hash64(shingle) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    bits = (hashes[:, None] >> np.arange(64, dtype=np.uint64)) & np.uint64(1)
+    majority = bits.sum(axis=0) * 2 > len(hashes)
+    return int(np.sum(np.left_shift(np.uint64(1), np.arange(64, dtype=np.uint64))[majority]))
+
+class ChunkDeduplicator:
+    """Streaming filter that drops exact and SimHash near-duplicate chunks.
+
+    Fingerprints are bucketed by SIMHASH_MAX_DISTANCE + 1 bit bands; two
+    fingerprints within the distance must agree on at least one band, so
+    only same-bucket candidates are compared.
+    """
+
+    def __init__(self, max_distance=SIMHASH_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.num_bands = max_distance + 1
+        self.band_bits = 64 // self.num_bands
+        self.exact_hashes = set()
+        self.buckets = defaultdict(list)
+        self.kept = 0
+        self.dropped_exact = 0
+        self.dropped_near = 0
+
+    def _bands(self, fingerprint):
+        mask = (1 << self.band_bits) - 1
+        return [(band, (fingerprint >> (band * self.band_bits)) & mask) for band in range(self.num_bands)]
+
+    def is_duplicate(self, text: str) -> bool:
+        """Checks text against everything seen so far and remembers it if new."""
+        exact_hash = hashlib.sha1(" ".join(text.lower().split()).encode("utf-8")).digest()
+        if exact_hash in self.exact_hashes:
+            self.dropped_exact += 1
+            return True
+
+        fingerprint = simhash(text)
+        bands = self._bands(fingerprint)
+        for band in bands:
+            for candidate in self.buckets.get(band, ()):
+                if bin(fingerprint ^ candidate).count("1") <= self.max_distance:
+                    self.dropped_near += 1
+                    return True
+
+        self.exact_hashes.add(exact_hash)
+        for band in bands:
+            self.buckets[band].append(fingerprint)
+        self.kept += 1
+        return False
+
+    def filter(self, chunks):
+        """Yields the non-duplicate items of a chunk stream (strings or (chunk, span) pairs)."""
+        for item in chunks:
+            if not self.is_duplicate(item if isinstance(item, str) else item[0]):
+                yield item
+
+    @property
+    def dropped(self):
+        return self.dropped_exact + self.dropped_near
+
+    def summary(self, seconds_per_chunk=None) -> str:
+        """Dropped-chunk counts, plus the embedding time saved when the encode rate is known."""
+        text = (f"dropped {self.dropped} duplicate chunks "
+                f"({self.dropped_exact} exact, {self.dropped_near} near)")
+        if seconds_per_chunk:
+            text += f", ~{self.dropped * seconds_per_chunk:.1f}s embedding saved"
+        return text
+
+def load_and_chunk_pdf(file_path, max_tokens=None, overlap_sentences=CHUNK_OVERLAP_SENTENCES):
     """Loads text from a PDF file and chunks it."""
     if not file_path or not os.path.exists(file_path):
         print(f"Error: PDF file not found at {file_path}")
         return None
     try:
         print(f"Loading PDF: {file_path}")
-        reader = PdfReader(file_path)
-        text = ""
-        for i, page in enumerate(reader.pages):
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text + "\n"
+        chunks = [chunk for chunk, _ in iter_pdf_chunks(file_path, max_tokens, overlap_sentences)]
 
-        if not text:
+        if not chunks:
             print("Error: No text extracted from the PDF.")
             return None
 
-        text = re.sub(r'\n\s*\n', '\n', text).strip()
-        text = re.sub(r'\s+', ' ', text).strip()
-
-        chunks = []
-        start_index = 0
-        while start_index < len(text):
-            end_index = start_index + chunk_size
-            chunks.append(text[start_index:end_index])
-            start_index += chunk_size - chunk_overlap
-
-        chunks = [chunk for chunk in chunks if len(chunk.strip()) > 50]
         print(f"Document loaded and split into {len(chunks)} chunks.")
         return chunks
     except Exception as e:
         print(f"Error loading PDF: {e}")
         return None
 
-def build_vector_store(chunks, embedder_model):
-    """Generates embeddings and builds FAISS index."""
-    if not chunks or embedder_model is None:
-        return None, None
-    try:
-        print(f"Generating embeddings for {len(chunks)} chunks...")
-        embeddings = embedder_model.encode(chunks, convert_to_tensor=False, show_progress_bar=True)
-        embeddings_np = np.array(embeddings).astype('float32')
+def benchmark_pdf_extraction(file_path, worker_counts=(1, 2, 4)):
+    """Compares sequential and process-pool text extraction in pages/sec."""
+    num_pages = len(PdfReader(file_path).pages)
+    results = {}
+    for workers in worker_counts:
+        start = time.perf_counter()
+        for _ in iter_pdf_pages(file_path, workers=workers):
+            pass
+        elapsed = time.perf_counter() - start
+        results[workers] = num_pages / elapsed if elapsed > 0 else float("inf")
+        print(f"workers={workers}: {num_pages} pages in {elapsed:.2f}s "
+              f"({results[workers]:.1f} pages/sec)")
+    return results
+
+def _batched(items, batch_size):
+    """Yields lists of up to batch_size items from any iterable."""
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def select_index_type(num_vectors, allow_hnsw=True):
+    """Picks an index engine for num_vectors vectors.
+
+    HNSW cannot remove vectors, so the corpus asks for IVF-Flat instead.
+    """
+    if num_vectors < FLAT_INDEX_MAX_VECTORS:
+        return "flat"
+    if num_vectors < IVF_PQ_MIN_VECTORS:
+        return "hnsw" if allow_hnsw else "ivf_flat"
+    return "ivf_pq"
+
+_STORAGE_CODES = {"float32": "Flat", "float16": "SQfp16", "sq8": "SQ8"}
+_FAISS_METRICS = {"l2": "METRIC_L2", "cosine": "METRIC_INNER_PRODUCT"}
+
+def _index_factory_string(index_type, dimension, num_vectors, storage=VECTOR_STORAGE):
+    """Translates an index engine name into a FAISS index_factory description."""
+    # k-means wants ~39 training points per centroid, and _train_index only
+    # sees up to FAISS_TRAIN_SAMPLE of the vectors
+    train_size = min(num_vectors, FAISS_TRAIN_SAMPLE)
+    nlist = max(1, min(int(4 * np.sqrt(num_vectors)), train_size // 39))
+    code = _STORAGE_CODES[storage]
+    if index_type == "flat":
+        return code
+    if index_type == "ivf_flat":
+        return f"IVF{nlist},{code}"
+    if index_type == "ivf_pq":
+        # 8-dimensional sub-vectors with 8-bit codes: 384 floats -> 48 bytes
+        subquantizers = next(m for m in (dimension // 8, dimension // 4, dimension // 2, dimension)
+                             if m > 0 and dimension % m == 0)
+        return f"IVF{nlist},PQ{subquantizers}"
+    if index_type == "hnsw":
+        return f"HNSW{HNSW_M}" if storage == "float32" else f"HNSW{HNSW_M},{code}"
+    raise ValueError(f"Unknown index type: {index_type}")
+
+def set_search_params(index, nprobe=FAISS_NPROBE, ef_search=FAISS_EF_SEARCH):
+    """Applies nprobe/efSearch to whichever engine the index uses."""
+    parameter_space = faiss.ParameterSpace()
+    for name, value in (("nprobe", nprobe), ("efSearch", ef_search)):
+        try:
+            parameter_space.set_index_parameter(index, name, value)
+        except RuntimeError:
+            pass  # Parameter does not apply to this engine
+
+def _train_index(index, embeddings):
+    """Trains IVF centroids / PQ codebooks on a random sample of the embeddings."""
+    if index.is_trained:
+        return
+    sample_size = min(len(embeddings), FAISS_TRAIN_SAMPLE)
+    sample = embeddings[np.random.default_rng(0).choice(len(embeddings), sample_size, replace=False)]
+    print(f"Training index on {sample_size} sampled vectors...")
+    index.train(np.ascontiguousarray(sample))
+
+def normalize_for_index(index, vectors):
+    """L2-normalizes float32 vectors in place when the index searches by inner product."""
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        faiss.normalize_L2(vectors)
+    return vectors
+
+def create_faiss_index(embeddings, index_type=VECTOR_INDEX_TYPE, with_ids=False,
+                       metric=VECTOR_METRIC, storage=VECTOR_STORAGE):
+    """Creates a trained, empty FAISS index suited to the given embeddings.
+
+    "auto" chooses by size; ANN engines fall back to flat when there are too
+    few vectors to train them. with_ids returns an index that accepts
+    add_with_ids/remove_ids (used by DocumentCorpus). For the cosine metric,
+    embeddings must already be normalized (see normalize_for_index).
+    """
+    num_vectors, dimension = embeddings.shape
+    if index_type == "auto":
+        index_type = select_index_type(num_vectors, allow_hnsw=not with_ids)
+    elif index_type != "flat" and num_vectors < ANN_MIN_TRAIN_VECTORS:
+        index_type = "flat"
+
+    description = _index_factory_string(index_type, dimension, num_vectors, storage)
+    if with_ids and index_type in ("flat", "hnsw"):
+        description = f"IDMap2,{description}"
+    index = faiss.index_factory(dimension, description, getattr(faiss, _FAISS_METRICS[metric]))
+
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and with_ids:
+        # Lets the corpus reconstruct vectors by ID when it re-indexes
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+
+    _train_index(index, embeddings)
+    set_search_params(index)
+    return index
+
+def index_vectors(index):
+    """Returns every vector stored in a sequentially numbered index."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+def chunk_hash(text):
+    """Content hash identifying a chunk across documents and revisions."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """Persistent, content-addressed store of chunk embeddings.
+
+    Rows are keyed by (embedding model, chunk hash) in SQLite, so text shared
+    between documents (appendices, legal boilerplate, templates) is embedded
+    once across documents and restarts. Once the stored vectors exceed
+    max_bytes, the least recently used rows are evicted.
+    """
+
+    _SQLITE_MAX_PARAMS = 500
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, max_bytes: int = EMBEDDING_CACHE_MAX_MB * 2**20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._stored_bytes = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        # Opened on first use so importing the app does not touch the disk
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, chunk_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+                "last_used REAL NOT NULL, PRIMARY KEY (model, chunk_hash))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self._stored_bytes = self._conn.execute(
+                "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+        return self._conn
+
+    def get_many(self, model: str, hashes: List[str]) -> Dict[str, np.ndarray]:
+        """Returns the cached vectors among hashes, marking them as recently used."""
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            conn = self._connection()
+            for start in range(0, len(unique), self._SQLITE_MAX_PARAMS):
+                batch = unique[start:start + self._SQLITE_MAX_PARAMS]
+                rows = conn.execute(
+                    f"SELECT chunk_hash, vector FROM embeddings "
+                    f"WHERE model = ? AND chunk_hash IN ({', '.join('?' * len(batch))})",
+                    [model, *batch]).fetchall()
+                found.update((h, np.frombuffer(vector, dtype='float32')) for h, vector in rows)
+            if found:
+                now = time.time()
+                conn.executemany("UPDATE embeddings SET last_used = ? WHERE model = ? AND chunk_hash = ?",
+                                 [(now, model, h) for h in found])
+                conn.commit()
+            hits = sum(h in found for h in hashes)
+            self.hits += hits
+            self.misses += len(hashes) - hits
+        return found
+
+    def put_many(self, model: str, hashes: List[str], vectors: np.ndarray):
+        now = time.time()
+        rows = list({h: (model, h, np.asarray(vector, dtype='float32').tobytes(), now)
+                     for h, vector in zip(hashes, vectors)}.values())
+        with self._lock:
+            conn = self._connection()
+            # Rows being replaced are subtracted, so _stored_bytes stays exact without a table scan
+            replaced_bytes = 0
+            for start in range(0, len(rows), self._SQLITE_MAX_PARAMS):
+                batch = [row[1] for row in rows[start:start + self._SQLITE_MAX_PARAMS]]
+                replaced_bytes += conn.execute(
+                    f"SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings "
+                    f"WHERE model = ? AND chunk_hash IN ({', '.join('?' * len(batch))})",
+                    [model, *batch]).fetchone()[0]
+            conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self._stored_bytes += sum(len(row[2]) for row in rows) - replaced_bytes
+            if self._stored_bytes > self.max_bytes:
+                self._evict(conn)
+            conn.commit()
+
+    def _evict(self, conn):
+        excess = self._stored_bytes - self.max_bytes
+        stale = []
+        for rowid, size in conn.execute("SELECT rowid, LENGTH(vector) FROM embeddings ORDER BY last_used"):
+            if excess <= 0:
+                break
+            stale.append((rowid,))
+            excess -= size
+            self._stored_bytes -= size
+        conn.executemany("DELETE FROM embeddings WHERE rowid = ?", stale)
+        self.evicted += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._connection().execute("DELETE FROM embeddings")
+            self._conn.commit()
+            self._stored_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evicted = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            entries = self._connection().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "size_mb": self._stored_bytes / 2**20,
+            "max_mb": self.max_bytes / 2**20,
+            "hits": self.hits,
+            "misses": self.misses,
+            "reuse_rate": self.hits / lookups if lookups else 0.0,
+            "evicted": self.evicted,
+        }
 
-        embedding_dim = embeddings_np.shape[1]
-        index = faiss.IndexFlatL2(embedding_dim)
+    def summary(self) -> str:
+        stats = self.stats()
+        return (f"Embedding cache: {stats['hits']}/{stats['hits'] + stats['misses']} chunks reused "
+                f"({stats['reuse_rate']:.0%}), {stats['entries']} stored "
+                f"({stats['size_mb']:.1f}/{stats['max_mb']:.0f} MB), {stats['evicted']} evicted")
+
+embedding_cache = EmbeddingCache() if EMBEDDING_CACHE_ENABLED else None
+
+def length_sorted_batches(lengths, max_batch_size=EMBEDDING_BATCH_SIZE,
+                          max_batch_tokens=EMBEDDING_BATCH_TOKENS):
+    """Groups positions into batches of similar token length.
+
+    Positions are sorted by length so little padding is wasted, and each
+    batch holds as many chunks as fit in max_batch_tokens once padded to
+    its longest member (capped at max_batch_size).
+    """
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    batches = []
+    batch = []
+    for position in order:
+        # Sorted ascending, so the newest member is the longest
+        if batch and (len(batch) >= max_batch_size or
+                      (len(batch) + 1) * lengths[position] > max_batch_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(position)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def encode_length_sorted(texts, embedder_model, max_batch_size=EMBEDDING_BATCH_SIZE,
+                         max_batch_tokens=EMBEDDING_BATCH_TOKENS):
+    """Encodes texts in length-bucketed, adaptively sized batches, in input order."""
+    max_seq_length = getattr(embedder_model, "max_seq_length", None) or 512
+    token_counts = get_token_counter(embedder_model).count_many(texts)
+    lengths = [min(count + 2, max_seq_length) for count in token_counts]
+
+    embeddings = None
+    for batch in length_sorted_batches(lengths, max_batch_size, max_batch_tokens):
+        encoded = np.asarray(embedder_model.encode([texts[p] for p in batch], batch_size=len(batch),
+                                                   convert_to_tensor=False, show_progress_bar=False),
+                             dtype='float32')
+        if embeddings is None:
+            embeddings = np.empty((len(texts), encoded.shape[1]), dtype='float32')
+        embeddings[batch] = encoded
+    return embeddings
+
+def embed_texts(texts, embedder_model, batch_size=EMBEDDING_BATCH_SIZE, use_cache=True):
+    """Encodes chunk texts into a float32 embedding matrix.
+
+    Texts are batched by length (see encode_length_sorted). With use_cache,
+    texts already in the embedding cache are not re-encoded and newly
+    encoded ones are added to it.
+    """
+    if not use_cache or embedding_cache is None:
+        return encode_length_sorted(texts, embedder_model, max_batch_size=batch_size)
+
+    model = embedder_name(embedder_model)
+    hashes = [chunk_hash(text) for text in texts]
+    cached = embedding_cache.get_many(model, hashes)
+    missing = {h: text for h, text in zip(hashes, texts) if h not in cached}
+    if missing:
+        encoded = embed_texts(list(missing.values()), embedder_model, batch_size, use_cache=False)
+        embedding_cache.put_many(model, list(missing), encoded)
+        cached.update(zip(missing, encoded))
+    return np.stack([cached[h] for h in hashes])
+
+def build_vector_store(chunks, embedder_model, batch_size=EMBEDDING_BATCH_SIZE,
+                       index_type=VECTOR_INDEX_TYPE, stats=None, sort_window=EMBEDDING_SORT_WINDOW,
+                       storage=VECTOR_STORAGE):
+    """Generates embeddings and builds FAISS index.
+
+    chunks may be a list of strings or (chunk, (start, end)) pairs, including
+    a generator such as iter_pdf_chunks. Every sort_window chunks are
+    embedded as soon as they arrive, batched by length (see embed_texts).
+    The index engine is created once the final size is known (see
+    create_faiss_index).
+
+    Returns (index, chunk texts, chunk offsets), with None offsets for plain
+    strings. If a stats dict is passed, the time spent in encode is recorded
+    in it as "embedding_seconds". Pass index_type="flat" and
+    storage="float32" to keep the raw vectors (as index_document does).
+    """
+    if chunks is None or embedder_model is None:
+        return None, None, None
+    try:
+        embedding_batches = []
+        indexed_chunks = []
+        chunk_offsets = []
+        embedding_seconds = 0.0
+        for batch in _batched(chunks, sort_window):
+            texts = [item if isinstance(item, str) else item[0] for item in batch]
+            start = time.perf_counter()
+            embedding_batches.append(embed_texts(texts, embedder_model, batch_size))
+            embedding_seconds += time.perf_counter() - start
+            indexed_chunks.extend(texts)
+            chunk_offsets.extend(None if isinstance(item, str) else tuple(item[1]) for item in batch)
+            print(f"Embedded {len(indexed_chunks)} chunks...")
+
+        if stats is not None:
+            stats["embedding_seconds"] = embedding_seconds
+        if not indexed_chunks:
+            print("Error: No chunks to index.")
+            return None, None, None
+
+        embeddings_np = np.concatenate(embedding_batches)
+        if VECTOR_METRIC == "cosine":
+            faiss.normalize_L2(embeddings_np)
+        index = create_faiss_index(embeddings_np, index_type, storage=storage)
         index.add(embeddings_np)
 
         print(f"FAISS index created with {index.ntotal} vectors.")
-        return index, chunks
+        return index, indexed_chunks, chunk_offsets
     except Exception as e:
         print(f"Error building vector store: {e}")
-        return None, None
+        return None, None, None
+
+def benchmark_embedding_throughput(texts, embedder_model=None, batch_sizes=(16, 32, 64, 128),
+                                   batch_tokens=(2048, 8192, 32768)):
+    """Reports chunks/sec of fixed-size batches in arrival order vs length-sorted batches.
+
+    The embedding cache is bypassed. Pass real chunks (e.g. from
+    load_and_chunk_pdf) so the length distribution is representative.
+    """
+    embedder_model = embedder_model or embedder
+    texts = list(texts)
+    results = []
+
+    def run(label, encode):
+        encode(texts[:8])  # Warm up kernels and the token counter
+        start = time.perf_counter()
+        encode(texts)
+        chunks_per_sec = len(texts) / (time.perf_counter() - start)
+        print(f"{label:<28} {chunks_per_sec:9.1f} chunks/sec")
+        results.append({"config": label, "chunks_per_sec": chunks_per_sec})
+
+    for batch_size in batch_sizes:
+        run(f"arrival order, batch={batch_size}",
+            lambda items: [embedder_model.encode(batch, batch_size=batch_size, show_progress_bar=False)
+                           for batch in _batched(items, batch_size)])
+    for tokens in batch_tokens:
+        run(f"length-sorted, {tokens} tokens",
+            lambda items: encode_length_sorted(items, embedder_model, max_batch_tokens=tokens))
+    return results
+
+def _clustered_vectors(rng, num_vectors, dimension, num_clusters=256):
+    """Synthetic float32 vectors around random centers, standing in for embeddings in benchmarks."""
+    centers = rng.normal(size=(num_clusters, dimension)).astype('float32')
+    vectors = centers[rng.integers(0, num_clusters, num_vectors)]
+    vectors += 0.3 * rng.normal(size=vectors.shape).astype('float32')
+    return vectors
+
+def _recall_at_k(found, ground_truth, top_k):
+    """Mean fraction of each query's true top_k neighbours among the found IDs."""
+    return float(np.mean([len(set(row) & set(truth)) / top_k for row, truth in zip(found, ground_truth)]))
+
+def benchmark_ann_indexes(embeddings=None, num_vectors=200_000, dimension=384, top_k=10,
+                          num_queries=500, nprobes=(1, 4, 16, 64), ef_searches=(16, 64, 256)):
+    """Reports recall@k and per-query latency of each ANN engine against flat search.
+
+    Pass real embeddings (e.g. index_vectors(index)) for representative
+    recall; otherwise clustered random vectors are generated.
+    """
+    rng = np.random.default_rng(0)
+    if embeddings is None:
+        embeddings = _clustered_vectors(rng, num_vectors, dimension)
+    embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+    query_ids = rng.choice(len(embeddings), min(num_queries, len(embeddings)), replace=False)
+    queries = embeddings[query_ids] + 0.05 * rng.normal(size=(len(query_ids), embeddings.shape[1])).astype('float32')
+
+    def run(index, label):
+        start = time.perf_counter()
+        _, found = index.search(queries, top_k)
+        latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        recall = _recall_at_k(found, ground_truth, top_k)
+        print(f"{label:<28} recall@{top_k}={recall:.3f}  {latency_ms:.3f} ms/query")
+        return {"index": label, "recall": recall, "latency_ms": latency_ms}
+
+    flat = faiss.IndexFlatL2(embeddings.shape[1])
+    flat.add(embeddings)
+    _, ground_truth = flat.search(queries, top_k)
+    results = [run(flat, "flat")]
+
+    for index_type in ("ivf_flat", "ivf_pq", "hnsw"):
+        start = time.perf_counter()
+        index = create_faiss_index(embeddings, index_type)
+        index.add(embeddings)
+        print(f"{index_type}: built in {time.perf_counter() - start:.1f}s")
+        if index_type == "hnsw":
+            for ef_search in ef_searches:
+                set_search_params(index, ef_search=ef_search)
+                results.append(run(index, f"hnsw efSearch={ef_search}"))
+        else:
+            for nprobe in nprobes:
+                set_search_params(index, nprobe=nprobe)
+                results.append(run(index, f"{index_type} nprobe={nprobe}"))
+    return results
+
+def benchmark_vector_storage(embeddings=None, num_vectors=100_000, dimension=384,
+                             top_k=10, num_queries=500):
+    """Compares memory, latency and recall@k of float32/float16/8-bit cosine storage.
+
+    Ground truth is exact float32 cosine search. Pass real embeddings for
+    representative recall; otherwise clustered random vectors are generated.
+    """
+    rng = np.random.default_rng(0)
+    if embeddings is None:
+        embeddings = _clustered_vectors(rng, num_vectors, dimension)
+    embeddings = np.array(embeddings, dtype='float32')
+    faiss.normalize_L2(embeddings)
+    queries = embeddings[rng.choice(len(embeddings), min(num_queries, len(embeddings)), replace=False)]
+
+    results = []
+    ground_truth = None
+    for storage in ("float32", "float16", "sq8"):
+        index = create_faiss_index(embeddings, "flat", metric="cosine", storage=storage)
+        index.add(embeddings)
+
+        start = time.perf_counter()
+        _, found = index.search(queries, top_k)
+        latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        if ground_truth is None:
+            ground_truth = found
+        recall = _recall_at_k(found, ground_truth, top_k)
+        memory_mb = index.ntotal * index.sa_code_size() / 1e6
+        print(f"{storage:<8} {memory_mb:8.1f} MB  recall@{top_k}={recall:.3f}  {latency_ms:.3f} ms/query")
+        results.append({"storage": storage, "memory_mb": memory_mb, "recall": recall,
+                        "latency_ms": latency_ms})
+    return results
+
+def compute_document_key(file_path, max_tokens=None, overlap_sentences=CHUNK_OVERLAP_SENTENCES):
+    """Hashes the file bytes plus every setting that changes the resulting index."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+
+    params = {
+        "chunker": "sentences",
+        "max_tokens": max_tokens or chunk_token_budget(),
+        "overlap_sentences": overlap_sentences,
+        "dedup": DEDUP_CHUNKS and SIMHASH_MAX_DISTANCE,
+        "min_chunk_chars": MIN_CHUNK_CHARS,
+        "embedding_model": embedder_name(),
+        "store_format": "flat-float32",  # Engine and storage are chosen by the corpus, not persisted
+        "metric": VECTOR_METRIC,
+    }
+    digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+def save_vector_store(doc_key, index, chunks, chunk_offsets=None, cache_dir=VECTOR_STORE_DIR):
+    """Saves the FAISS index, chunk texts, offsets and embedding metadata under doc_key."""
+    store_dir = os.path.join(cache_dir, doc_key)
+    tmp_dir = f"{store_dir}.tmp"
+    try:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        faiss.write_index(index, os.path.join(tmp_dir, "index.faiss"))
+        with open(os.path.join(tmp_dir, "chunks.json"), "w", encoding="utf-8") as f:
+            json.dump(chunks, f, ensure_ascii=False)
+        with open(os.path.join(tmp_dir, "offsets.json"), "w", encoding="utf-8") as f:
+            json.dump(chunk_offsets or [None] * len(chunks), f)
+
+        metadata = {
+            "embedding_model": embedder_name(),
+            "dimension": index.d,
+            "num_vectors": index.ntotal,
+            "created_at": time.time(),
+        }
+        with open(os.path.join(tmp_dir, "metadata.json"), "w", encoding="utf-8") as f:
+            json.dump(metadata, f, indent=2)
+
+        # Swap the finished directory in so readers never see a partial store
+        shutil.rmtree(store_dir, ignore_errors=True)
+        os.replace(tmp_dir, store_dir)
+        print(f"Vector store saved to {store_dir}")
+        return True
+    except Exception as e:
+        print(f"Error saving vector store: {e}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return False
+
+def load_vector_store(doc_key, cache_dir=VECTOR_STORE_DIR):
+    """Loads a persisted vector store, memory-mapping the index where FAISS supports it.
+
+    Returns (index, chunk texts, chunk offsets) or (None, None, None).
+    """
+    store_dir = os.path.join(cache_dir, doc_key)
+    if not os.path.isdir(store_dir):
+        return None, None, None
+    try:
+        with open(os.path.join(store_dir, "metadata.json"), encoding="utf-8") as f:
+            metadata = json.load(f)
+        if metadata.get("embedding_model") != embedder_name():
+            return None, None, None
+
+        index_path = os.path.join(store_dir, "index.faiss")
+        try:
+            index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP)
+        except RuntimeError:
+            index = faiss.read_index(index_path)
+
+        with open(os.path.join(store_dir, "chunks.json"), encoding="utf-8") as f:
+            chunks = json.load(f)
+
+        offsets_path = os.path.join(store_dir, "offsets.json")
+        chunk_offsets = [None] * len(chunks)
+        if os.path.exists(offsets_path):
+            with open(offsets_path, encoding="utf-8") as f:
+                chunk_offsets = [tuple(span) if span else None for span in json.load(f)]
+
+        if index.ntotal != len(chunks) or len(chunk_offsets) != len(chunks):
+            print(f"Ignoring inconsistent vector store at {store_dir}")
+            return None, None, None
+        set_search_params(index)
+
+        print(f"Loaded vector store with {index.ntotal} vectors from {store_dir}")
+        return index, chunks, chunk_offsets
+    except Exception as e:
+        print(f"Error loading vector store: {e}")
+        return None, None, None
+
+"""### 📚 Part 5b: Multi-Document Corpus"""
+
+_BM25_TOKEN_PATTERN = re.compile(r"\w+(?:[-./]\w+)*")
+
+def tokenize_for_bm25(text):
+    """Lower-cased word tokens; identifiers like AB-1234 or v2.1 are kept whole and split."""
+    tokens = []
+    for token in _BM25_TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        if not token.isalnum():
+            tokens.extend(part for part in re.split(r"[-./_]", token) if part)
+    return tokens
+
+class BM25Index:
+    """Inverted index with vectorized BM25 scoring over integer chunk IDs.
+
+    Postings are stored per term as numpy arrays, so a query only touches the
+    chunks containing its terms and chunks can be added or removed in place.
+    """
+
+    def __init__(self, k1=BM25_K1, b=BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}  # term -> (chunk ids, term counts)
+        self.chunk_terms: Dict[int, Tuple[str, ...]] = {}
+        self.chunk_lengths = np.zeros(0, dtype='float32')  # Indexed by chunk ID
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.chunk_terms)
+
+    def add(self, chunk_ids: List[int], texts: List[str]):
+        """Indexes texts under the given chunk IDs."""
+        if not chunk_ids:
+            return
+        if max(chunk_ids) >= len(self.chunk_lengths):
+            grown = np.zeros(max(max(chunk_ids) + 1, 2 * len(self.chunk_lengths)), dtype='float32')
+            grown[:len(self.chunk_lengths)] = self.chunk_lengths
+            self.chunk_lengths = grown
+
+        new_postings = defaultdict(lambda: ([], []))
+        for chunk_id, text in zip(chunk_ids, texts):
+            counts = Counter(tokenize_for_bm25(text))
+            length = sum(counts.values())
+            self.chunk_lengths[chunk_id] = length
+            self.total_length += length
+            self.chunk_terms[chunk_id] = tuple(counts)
+            for term, count in counts.items():
+                new_postings[term][0].append(chunk_id)
+                new_postings[term][1].append(count)
+
+        for term, (ids, counts) in new_postings.items():
+            ids = np.asarray(ids, dtype='int64')
+            counts = np.asarray(counts, dtype='float32')
+            if term in self.postings:
+                old_ids, old_counts = self.postings[term]
+                ids = np.concatenate([old_ids, ids])
+                counts = np.concatenate([old_counts, counts])
+            self.postings[term] = (ids, counts)
+
+    def remove(self, chunk_ids: List[int]):
+        """Removes chunks, touching only the postings of their own terms."""
+        removed = np.asarray(chunk_ids, dtype='int64')
+        affected_terms = set()
+        for chunk_id in chunk_ids:
+            affected_terms.update(self.chunk_terms.pop(chunk_id, ()))
+            self.total_length -= int(self.chunk_lengths[chunk_id])
+            self.chunk_lengths[chunk_id] = 0
+
+        for term in affected_terms:
+            ids, counts = self.postings[term]
+            keep = ~np.isin(ids, removed)
+            if keep.any():
+                self.postings[term] = (ids[keep], counts[keep])
+            else:
+                del self.postings[term]
+
+    def search(self, query: str, top_k: int, allowed_ids: Optional[np.ndarray] = None
+               ) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns (chunk ids, BM25 scores) of the best top_k chunks, best first."""
+        num_chunks = len(self.chunk_terms)
+        matched = [self.postings[term] for term in set(tokenize_for_bm25(query)) if term in self.postings]
+        if not matched or num_chunks == 0:
+            return np.empty(0, dtype='int64'), np.empty(0, dtype='float32')
+
+        average_length = self.total_length / num_chunks
+        all_ids, all_scores = [], []
+        for ids, counts in matched:
+            idf = np.log(1.0 + (num_chunks - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * self.chunk_lengths[ids] / average_length)
+            all_ids.append(ids)
+            all_scores.append(idf * counts * (self.k1 + 1.0) / (counts + norm))
+
+        ids, inverse = np.unique(np.concatenate(all_ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(all_scores))
+        if allowed_ids is not None:
+            keep = np.isin(ids, allowed_ids)
+            ids, scores = ids[keep], scores[keep]
+
+        if len(ids) > top_k:
+            best = np.argpartition(-scores, top_k)[:top_k]
+            ids, scores = ids[best], scores[best]
+        order = np.argsort(-scores)
+        return ids[order], scores[order]
+
+def build_sparse_index(chunks):
+    """BM25 index for a standalone vector store, using list positions as chunk IDs."""
+    sparse_index = BM25Index()
+    sparse_index.add(list(range(len(chunks))), chunks)
+    return sparse_index
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """Fuses ranked chunk-ID lists; returns IDs ordered by fused score."""
+    fused = defaultdict(float)
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            fused[chunk_id] += 1.0 / (k + rank + 1)
+    return sorted(fused, key=fused.get, reverse=True)
+
+_CORPUS_INDEX_ORDER = {"flat": 0, "ivf_flat": 1, "ivf_pq": 2}
+
+def _synchronized(method):
+    """Runs a DocumentCorpus method under the corpus lock."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class DocumentCorpus:
+    """Shared FAISS index over many documents with per-chunk document IDs.
+
+    Chunks get corpus-wide integer IDs, so a document can be added, removed
+    or updated without re-embedding the rest of the corpus, and a revised
+    document only re-embeds the chunks whose text changed. The index starts
+    flat and is re-trained into IVF-Flat / IVF-PQ once the corpus grows past
+    the thresholds in the Vector Search config.
+
+    Uploads and queries run as concurrent Gradio events, and FAISS cannot
+    add or remove vectors during a search, so public methods hold an RLock
+    (also taken by search_chunks while it reads chunk data). update_document
+    releases it while embedding.
+    """
+
+    def __init__(self, index_type=VECTOR_INDEX_TYPE, metric=VECTOR_METRIC, storage=VECTOR_STORAGE):
+        if index_type not in ("auto", *_CORPUS_INDEX_ORDER):
+            raise ValueError(f"Corpus index type must be auto, flat, ivf_flat or ivf_pq, not {index_type}")
+        self.index_type = index_type
+        self.metric = metric
+        self.storage = storage
+        self.active_index_type = None
+        self.lock = threading.RLock()
+        self.index = None  # Created on first add; always supports add_with_ids/remove_ids
+        self.chunks: Dict[int, str] = {}
+        self.chunk_docs: Dict[int, str] = {}
+        self.chunk_offsets: Dict[int, Optional[Tuple[int, int]]] = {}
+        self.chunk_hashes: Dict[int, str] = {}
+        self.sparse = BM25Index()  # Keyword index kept in step with the FAISS index
+        self.documents: Dict[str, Dict] = {}
+        self._next_id = 0
+
+    @_synchronized
+    def __len__(self):
+        return len(self.chunks)
+
+    @_synchronized
+    def add_document(self, doc_id: str, name: str, chunks: List[str], embeddings: np.ndarray,
+                     chunk_offsets: Optional[List[Optional[Tuple[int, int]]]] = None,
+                     content_key: Optional[str] = None) -> int:
+        """Adds a document's chunks and embeddings, replacing any previous version."""
+        if doc_id in self.documents:
+            self.remove_document(doc_id)
+
+        chunk_ids = self._add_chunks(doc_id, chunks, embeddings, chunk_offsets or [None] * len(chunks))
+        self.documents[doc_id] = {"name": name, "chunk_ids": chunk_ids, "content_key": content_key}
+        return len(chunk_ids)
+
+    def update_document(self, doc_id: str, name: str, chunks: List[str],
+                        chunk_offsets: List[Optional[Tuple[int, int]]], embed_fn,
+                        content_key: Optional[str] = None) -> Dict[str, int]:
+        """Re-indexes a revised document in place, embedding only changed chunks.
+
+        Chunks are matched to the stored version by content hash; unchanged
+        ones keep their vectors and IDs, vanished ones are removed and
+        embed_fn(texts) is called only for new text. Returns kept/added/removed
+        counts.
+
+        The diff and embed_fn run outside the lock, so searches are not blocked
+        while the changed chunks are encoded. If the document changes in the
+        meantime, the diff is redone against the new version.
+        """
+        hashes = [chunk_hash(text) for text in chunks]
+        while True:
+            with self.lock:
+                document = self.documents.get(doc_id)
+                stored_ids = None if document is None else document["chunk_ids"]
+                stored_hashes = ([] if stored_ids is None else
+                                 [(chunk_id, self.chunk_hashes[chunk_id]) for chunk_id in stored_ids.tolist()])
+
+            existing = defaultdict(list)
+            for chunk_id, stored_hash in stored_hashes:
+                existing[stored_hash].append(chunk_id)
+            chunk_ids = []
+            changed = []  # Positions of chunks that need embedding
+            for position, text_hash in enumerate(hashes):
+                matches = existing.get(text_hash)
+                chunk_ids.append(matches.pop() if matches else None)
+                if chunk_ids[-1] is None:
+                    changed.append(position)
+            stale = [chunk_id for ids in existing.values() for chunk_id in ids]
+            embeddings = embed_fn([chunks[p] for p in changed]) if changed else None
+
+            with self.lock:
+                document = self.documents.get(doc_id)
+                if (None if document is None else document["chunk_ids"]) is not stored_ids:
+                    continue  # Replaced or removed while embedding
+                if document is None:
+                    self.add_document(doc_id, name, chunks, embeddings, chunk_offsets, content_key)
+                    return {"kept": 0, "added": len(chunks), "removed": 0}
+
+                if stale:
+                    self._remove_chunks(np.asarray(stale, dtype='int64'))
+                if changed:
+                    new_ids = self._add_chunks(doc_id, [chunks[p] for p in changed], embeddings,
+                                               [chunk_offsets[p] for p in changed])
+                    for position, chunk_id in zip(changed, new_ids.tolist()):
+                        chunk_ids[position] = chunk_id
+
+                # Unchanged chunks may have moved within the document
+                for chunk_id, span in zip(chunk_ids, chunk_offsets):
+                    self.chunk_offsets[chunk_id] = span
+                document.update(name=name, chunk_ids=np.asarray(chunk_ids, dtype='int64'),
+                                content_key=content_key)
+                return {"kept": len(chunks) - len(changed), "added": len(changed), "removed": len(stale)}
+
+    @_synchronized
+    def document_vectors(self, doc_id: str) -> np.ndarray:
+        """Stored vectors of a document's chunks, in document order."""
+        return self.index.reconstruct_batch(self.documents[doc_id]["chunk_ids"])
+
+    def _add_chunks(self, doc_id: str, chunks: List[str], embeddings: np.ndarray,
+                    chunk_offsets: List[Optional[Tuple[int, int]]]) -> np.ndarray:
+        """Indexes chunks under fresh IDs in the dense and sparse indexes."""
+        embeddings = np.array(embeddings, dtype='float32')
+        if self.metric == "cosine":
+            faiss.normalize_L2(embeddings)
+        target = self._target_index_type(len(self.chunks) + len(chunks))
+        if (self.index is None or
+                _CORPUS_INDEX_ORDER[target] > _CORPUS_INDEX_ORDER[self.active_index_type]):
+            self._rebuild_index(target, embeddings)
+
+        chunk_ids = np.arange(self._next_id, self._next_id + len(chunks), dtype='int64')
+        self._next_id += len(chunks)
+        self.index.add_with_ids(embeddings, chunk_ids)
+
+        for chunk_id, text, span in zip(chunk_ids.tolist(), chunks, chunk_offsets):
+            self.chunks[chunk_id] = text
+            self.chunk_docs[chunk_id] = doc_id
+            self.chunk_offsets[chunk_id] = span
+            self.chunk_hashes[chunk_id] = chunk_hash(text)
+        self.sparse.add(chunk_ids.tolist(), chunks)
+        return chunk_ids
+
+    def _remove_chunks(self, chunk_ids: np.ndarray):
+        self.index.remove_ids(chunk_ids)
+        self.sparse.remove(chunk_ids.tolist())
+        for chunk_id in chunk_ids.tolist():
+            del self.chunks[chunk_id]
+            del self.chunk_docs[chunk_id]
+            del self.chunk_offsets[chunk_id]
+            del self.chunk_hashes[chunk_id]
+
+    def _target_index_type(self, num_vectors: int) -> str:
+        if self.index_type == "auto":
+            return select_index_type(num_vectors, allow_hnsw=False)
+        return self.index_type if num_vectors >= ANN_MIN_TRAIN_VECTORS else "flat"
+
+    def _rebuild_index(self, index_type: str, new_embeddings: np.ndarray):
+        """Moves every stored vector into a freshly trained index of index_type."""
+        if self.chunks:
+            chunk_ids = np.fromiter(self.chunks.keys(), dtype='int64', count=len(self.chunks))
+            vectors = self.index.reconstruct_batch(chunk_ids)
+            training_vectors = np.concatenate([vectors, new_embeddings])
+        else:
+            training_vectors = new_embeddings
+
+        if self.index is not None:
+            print(f"Re-indexing corpus as {index_type} ({len(training_vectors)} vectors)...")
+        index = create_faiss_index(training_vectors, index_type, with_ids=True,
+                                   metric=self.metric, storage=self.storage)
+        if self.chunks:
+            index.add_with_ids(vectors, chunk_ids)
+        self.index = index
+        self.active_index_type = index_type
+
+    @_synchronized
+    def remove_document(self, doc_id: str) -> int:
+        """Removes a document's vectors and chunks; returns the number removed."""
+        document = self.documents.pop(doc_id, None)
+        if document is None:
+            return 0
+
+        self._remove_chunks(document["chunk_ids"])
+        return len(document["chunk_ids"])
+
+    @_synchronized
+    def search(self, query_embeddings: np.ndarray, top_k: int,
+               doc_ids: Optional[List[str]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Same contract as faiss.Index.search, optionally restricted to doc_ids."""
+        if self.index is None:
+            raise ValueError("Corpus is empty.")
+        if not doc_ids:
+            return self.index.search(query_embeddings, top_k)
+
+        allowed = self.allowed_chunk_ids(doc_ids)
+        if not len(allowed):
+            count = len(query_embeddings)
+            return np.full((count, top_k), np.inf, dtype='float32'), np.full((count, top_k), -1, dtype='int64')
+
+        selector = faiss.IDSelectorBatch(allowed)
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        return self.index.search(query_embeddings, top_k, params=params)
+
+    @_synchronized
+    def allowed_chunk_ids(self, doc_ids: List[str]) -> np.ndarray:
+        """Chunk IDs belonging to doc_ids (unknown IDs are ignored)."""
+        allowed = [self.documents[d]["chunk_ids"] for d in doc_ids if d in self.documents]
+        return np.concatenate(allowed) if allowed else np.empty(0, dtype='int64')
+
+    @_synchronized
+    def document_choices(self) -> List[Tuple[str, str]]:
+        """(label, doc_id) pairs for the document filter dropdown."""
+        return [(f"{doc['name']} ({len(doc['chunk_ids'])} chunks)", doc_id)
+                for doc_id, doc in self.documents.items()]
+
+    @_synchronized
+    def memory_usage(self) -> Dict[str, int]:
+        """Approximate bytes held by vectors, the ID map and chunk texts."""
+        ntotal = self.index.ntotal if self.index is not None else 0
+        code_size = self.index.sa_code_size() if self.index is not None else 0
+        return {
+            "vectors": ntotal * code_size,
+            "ids": ntotal * 8,
+            "texts": sum(len(text.encode("utf-8")) for text in self.chunks.values()),
+        }
 
-def retrieve_context(query, vector_store, embedder_model, indexed_chunks, top_k=3):
-    """Retrieves relevant chunks."""
+    @_synchronized
+    def summary(self) -> str:
+        """One-line corpus status for the UI."""
+        usage = self.memory_usage()
+        return (f"📚 Corpus: {len(self.documents)} documents, {len(self.chunks)} chunks, "
+                f"{sum(usage.values()) / 1e6:.1f} MB ({self.active_index_type or 'empty'} index)")
+
+
+def benchmark_corpus_scaling(document_counts=(10, 100, 500), chunks_per_document=200,
+                             dimension=384, top_k=3, num_queries=100):
+    """Measures corpus memory and search latency as documents are added.
+
+    Uses random vectors, so it runs without the embedding model loaded.
+    """
+    rng = np.random.default_rng(0)
+    corpus = DocumentCorpus()
+    queries = rng.random((num_queries, dimension), dtype='float32')
+    results = []
+
+    for target in sorted(document_counts):
+        while len(corpus.documents) < target:
+            doc_id = f"doc-{len(corpus.documents)}"
+            corpus.add_document(doc_id, doc_id, [doc_id] * chunks_per_document,
+                                rng.random((chunks_per_document, dimension), dtype='float32'))
+
+        start = time.perf_counter()
+        for query in queries:
+            corpus.search(query[None, :], top_k)
+        search_ms = (time.perf_counter() - start) * 1000 / num_queries
+
+        start = time.perf_counter()
+        for query in queries:
+            corpus.search(query[None, :], top_k, doc_ids=["doc-0"])
+        filtered_ms = (time.perf_counter() - start) * 1000 / num_queries
+
+        start = time.perf_counter()
+        corpus.remove_document("doc-0")
+        remove_ms = (time.perf_counter() - start) * 1000
+        corpus.add_document("doc-0", "doc-0", ["doc-0"] * chunks_per_document,
+                            rng.random((chunks_per_document, dimension), dtype='float32'))
+
+        memory_mb = sum(corpus.memory_usage().values()) / 1e6
+        results.append({"documents": target, "chunks": len(corpus), "memory_mb": memory_mb,
+                        "search_ms": search_ms, "filtered_search_ms": filtered_ms,
+                        "remove_ms": remove_ms})
+        print(f"{target} docs / {len(corpus)} chunks: {memory_mb:.1f} MB, search {search_ms:.3f} ms, "
+              f"filtered {filtered_ms:.3f} ms, remove {remove_ms:.2f} ms")
+    return results
+
+class LRUCache:
+    """Thread-safe bounded mapping that evicts the least recently used entry.
+
+    With a ttl (seconds), entries also expire that long after being stored.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data and self.ttl is not None and self._expires[key] <= time.time():
+                del self._data[key]
+                del self._expires[key]
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, expires_at: Optional[float] = None):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if self.ttl is not None:
+                self._expires[key] = expires_at or time.time() + self.ttl
+            while len(self._data) > self.maxsize:
+                evicted, _ = self._data.popitem(last=False)
+                self._expires.pop(evicted, None)
+
+    def items(self) -> List[Tuple]:
+        """(key, value, expires_at) for live entries, least recently used first."""
+        with self._lock:
+            now = time.time()
+            return [(key, value, self._expires.get(key)) for key, value in self._data.items()
+                    if self.ttl is None or self._expires[key] > now]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+query_embedding_cache = LRUCache(QUERY_CACHE_SIZE)
+
+def normalize_query(query):
+    """Canonical form used to match repeated and trivially different questions."""
+    return " ".join(query.lower().split()).rstrip(" ?!.")
+
+def _query_cache_key(query, embedder_model):
+    return (embedder_name(embedder_model), normalize_query(query))
+
+def embed_query(query, embedder_model):
+    """Embeds a query, reusing cached embeddings for the same normalized text."""
+    key = _query_cache_key(query, embedder_model)
+    embedding = query_embedding_cache.get(key)
+    if embedding is None:
+        embedding = np.asarray(embedder_model.encode([key[1]], convert_to_tensor=False), dtype='float32')
+        query_embedding_cache.put(key, embedding)
+    # Callers normalize in place, so never hand out the cached array itself
+    return embedding.copy()
+
+def embed_queries(queries, embedder_model, batch_size=QUERY_BATCH_SIZE, use_cache=True):
+    """Embeds many queries with batched encode calls; returns a (n, dim) matrix.
+
+    Cached queries are skipped and each distinct normalized query is encoded once.
+    """
+    keys = [_query_cache_key(query, embedder_model) for query in queries]
+    rows = {}
+    if use_cache:
+        for key in set(keys):
+            embedding = query_embedding_cache.get(key)
+            if embedding is not None:
+                rows[key] = embedding[0]
+
+    missing = list(dict.fromkeys(key for key in keys if key not in rows))
+    if missing:
+        embeddings = np.asarray(embedder_model.encode([key[1] for key in missing], batch_size=batch_size,
+                                                      convert_to_tensor=False, show_progress_bar=False),
+                                dtype='float32')
+        for key, embedding in zip(missing, embeddings):
+            rows[key] = embedding
+            if use_cache:
+                # A copy, so the cached row does not keep the whole batch matrix alive
+                query_embedding_cache.put(key, embedding[None, :].copy())
+
+    return np.stack([rows[key] for key in keys])
+
+@dataclass
+class RetrievedChunk:
+    chunk_id: int
+    score: float  # Similarity, higher is better (see distance_to_score)
+    text: str
+    offsets: Optional[Tuple[int, int]] = None  # Character span in the normalized document
+    doc_id: Optional[str] = None
+    bm25_score: float = 0.0  # Keyword score when hybrid search matched the chunk lexically
+
+def _lookup_chunk(indexed_chunks, chunk_id):
+    """Returns the chunk text for a FAISS result id, or None for padding/stale ids."""
+    if isinstance(indexed_chunks, dict):
+        return indexed_chunks.get(int(chunk_id))
+    if 0 <= chunk_id < len(indexed_chunks):
+        return indexed_chunks[chunk_id]
+    return None
+
+def distance_to_score(index, distances):
+    """Converts FAISS distances into similarities where higher is better.
+
+    Inner-product (cosine) indexes already return similarities; L2 distances
+    are mapped to 1 / (1 + distance).
+    """
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return distances
+    return 1.0 / (1.0 + np.maximum(distances, 0.0))
+
+def _reconstruct_scores(index, query_embedding, chunk_ids):
+    """Dense similarity of one query to specific stored chunks (for keyword-only hits)."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.make_direct_map()
+    vectors = index.reconstruct_batch(np.asarray(chunk_ids, dtype='int64'))
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        distances = vectors @ query_embedding
+    else:
+        distances = ((vectors - query_embedding) ** 2).sum(axis=1)
+    return distance_to_score(index, distances)
+
+def search_chunks(query_embeddings, vector_store, indexed_chunks, top_k=3, doc_ids=None,
+                  chunk_offsets=None, queries=None, sparse_index=None,
+                  hybrid=HYBRID_SEARCH) -> List[List[RetrievedChunk]]:
+    """Runs one vectorized FAISS search over a matrix of query embeddings.
+
+    vector_store is either a FAISS index with a list of chunks (and optional
+    offsets and BM25 sparse_index), or a DocumentCorpus with its chunk dict;
+    doc_ids restricts a corpus search. With hybrid search and the query
+    texts, dense and BM25 candidates are merged by reciprocal rank fusion;
+    BM25 hits far below the best one (e.g. a shared "ab" token of a part
+    number) are dropped first so they cannot outrank the exact match.
+    Scores stay dense similarities so relevance cutoffs mean the same thing.
+    """
+    corpus = vector_store if isinstance(vector_store, DocumentCorpus) else None
+    with corpus.lock if corpus is not None else nullcontext():
+        if corpus is not None:
+            sparse_index = corpus.sparse
+        use_hybrid = hybrid and sparse_index is not None and queries is not None
+        fetch_k = max(top_k, HYBRID_CANDIDATES) if use_hybrid else top_k
+
+        if corpus is not None:
+            index = corpus.index
+            normalize_for_index(index, query_embeddings)
+            distances, indices = corpus.search(query_embeddings, fetch_k, doc_ids)
+        else:
+            index = vector_store
+            normalize_for_index(index, query_embeddings)
+            distances, indices = index.search(query_embeddings, fetch_k)
+        allowed_ids = corpus.allowed_chunk_ids(doc_ids) if corpus is not None and doc_ids else None
+
+        results = []
+        for row, (row_ids, row_scores) in enumerate(zip(indices, distance_to_score(index, distances))):
+            scores = {chunk_id: score for chunk_id, score in zip(row_ids.tolist(), row_scores.tolist())
+                      if _lookup_chunk(indexed_chunks, chunk_id) is not None}
+            ranking = list(scores)
+            bm25_scores = {}
+
+            if use_hybrid:
+                lexical_ids, lexical_scores = sparse_index.search(queries[row], HYBRID_CANDIDATES, allowed_ids)
+                if len(lexical_scores):
+                    strong = lexical_scores >= lexical_scores.max() * HYBRID_BM25_MIN_RATIO
+                    lexical_ids, lexical_scores = lexical_ids[strong], lexical_scores[strong]
+                bm25_scores = dict(zip(lexical_ids.tolist(), lexical_scores.tolist()))
+                ranking = reciprocal_rank_fusion([ranking, list(bm25_scores)])
+                keyword_only = [chunk_id for chunk_id in ranking[:top_k] if chunk_id not in scores]
+                if keyword_only:
+                    scores.update(zip(keyword_only, _reconstruct_scores(index, query_embeddings[row],
+                                                                        keyword_only).tolist()))
+
+            ranked = []
+            for chunk_id in ranking[:top_k]:
+                text = _lookup_chunk(indexed_chunks, chunk_id)
+                if corpus is not None:
+                    offsets, doc_id = corpus.chunk_offsets.get(chunk_id), corpus.chunk_docs.get(chunk_id)
+                else:
+                    offsets, doc_id = (chunk_offsets[chunk_id] if chunk_offsets else None), None
+                ranked.append(RetrievedChunk(chunk_id, float(scores[chunk_id]), text, offsets, doc_id,
+                                             bm25_scores.get(chunk_id, 0.0)))
+            results.append(ranked)
+        return results
+
+def filter_retrieved(retrieved: List[RetrievedChunk], min_score=RETRIEVAL_MIN_SCORE,
+                     adaptive_ratio=RETRIEVAL_ADAPTIVE_RATIO) -> List[RetrievedChunk]:
+    """Drops low-relevance chunks before they reach the prompt.
+
+    min_score is an absolute cutoff; adaptive_ratio shrinks top-k to the
+    chunks within that fraction of the best score. Both apply to the dense
+    similarity, so keyword matches from hybrid search (bm25_score > 0) are
+    exempt. Fused results are not sorted by score, so the best score is
+    taken over all kept chunks.
+    """
+    kept = [chunk for chunk in retrieved if chunk.bm25_score > 0 or chunk.score >= min_score]
+    if kept and adaptive_ratio > 0:
+        best_score = max(chunk.score for chunk in kept)
+        kept = [chunk for chunk in kept if chunk.bm25_score > 0 or chunk.score >= best_score * adaptive_ratio]
+    return kept
+
+def retrieve_chunks(query, vector_store, embedder_model, indexed_chunks, top_k=RETRIEVAL_TOP_K,
+                    doc_ids=None, min_score=RETRIEVAL_MIN_SCORE, adaptive_ratio=RETRIEVAL_ADAPTIVE_RATIO,
+                    chunk_offsets=None, sparse_index=None) -> List[RetrievedChunk]:
+    """Retrieves up to top_k scored chunks for a query, dropping low-relevance ones."""
     if vector_store is None or embedder_model is None or indexed_chunks is None:
-        return "Error: Vector store not initialized."
-    try:
-        query_embedding = embedder_model.encode([query], convert_to_tensor=False)
-        query_embedding_np = np.array(query_embedding).astype('float32')
+        raise ValueError("Vector store not initialized.")
+    query_embedding_np = embed_query(query, embedder_model)
+    retrieved = search_chunks(query_embedding_np, vector_store, indexed_chunks, top_k, doc_ids,
+                              chunk_offsets, [query], sparse_index)[0]
+    return filter_retrieved(retrieved, min_score, adaptive_ratio)
 
-        distances, indices = vector_store.search(query_embedding_np, top_k)
-        retrieved_chunks = [indexed_chunks[i] for i in indices[0] if 0 <= i < len(indexed_chunks)]
+def format_context(retrieved: List[RetrievedChunk]) -> str:
+    """Joins retrieved chunks into the CONTEXT block of the prompt."""
+    return "\n\n---\n\n".join(chunk.text for chunk in retrieved)
 
-        if not retrieved_chunks:
+def retrieve_context(query, vector_store, embedder_model, indexed_chunks, top_k=3, doc_ids=None):
+    """Retrieves relevant chunks."""
+    try:
+        retrieved = retrieve_chunks(query, vector_store, embedder_model, indexed_chunks, top_k, doc_ids)
+        if not retrieved:
             return "Could not find relevant context."
-
-        context = "\n\n---\n\n".join(retrieved_chunks)
-        return context
+        return format_context(retrieved)
+    except ValueError as e:
+        return f"Error: {e}"
     except Exception as e:
         print(f"Error during retrieval: {e}")
         return f"Error: {e}"
 
+def retrieve_batch(queries, vector_store, embedder_model, indexed_chunks, top_k=3, doc_ids=None,
+                   batch_size=QUERY_BATCH_SIZE, chunk_offsets=None,
+                   sparse_index=None) -> List[List[RetrievedChunk]]:
+    """Retrieves ranked chunks for many queries with batched encoding and one search.
+
+    Intended for offline evaluation runs; errors are raised, not returned as text.
+    """
+    if vector_store is None or embedder_model is None or indexed_chunks is None:
+        raise ValueError("Vector store not initialized.")
+    if not queries:
+        return []
+    query_embeddings = embed_queries(queries, embedder_model, batch_size)
+    return search_chunks(query_embeddings, vector_store, indexed_chunks, top_k, doc_ids,
+                         chunk_offsets, queries, sparse_index)
+
+def benchmark_batch_retrieval(queries, vector_store, embedder_model, indexed_chunks, top_k=3):
+    """Compares queries/sec of a per-query encode+search loop and retrieve_batch.
+
+    The query cache is bypassed so both paths pay for every encode.
+    """
+    start = time.perf_counter()
+    for query in queries:
+        query_embedding = np.asarray(embedder_model.encode([query], convert_to_tensor=False), dtype='float32')
+        search_chunks(query_embedding, vector_store, indexed_chunks, top_k)
+    loop_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    query_embeddings = embed_queries(queries, embedder_model, use_cache=False)
+    search_chunks(query_embeddings, vector_store, indexed_chunks, top_k)
+    batch_seconds = time.perf_counter() - start
+
+    results = {
+        "queries": len(queries),
+        "loop_qps": len(queries) / loop_seconds,
+        "batch_qps": len(queries) / batch_seconds,
+    }
+    print(f"{len(queries)} queries: loop {results['loop_qps']:.1f} q/s, "
+          f"batch {results['batch_qps']:.1f} q/s ({loop_seconds / batch_seconds:.1f}x)")
+    return results
+
 """### 🎯 Part 6: Multi-Strategy Prompt Generation"""
 
 class PromptBuilder:
@@ -383,6 +2205,20 @@ Let me break this down:
 
 COMPLETE ANSWER:"""
 
+    @staticmethod
+    def split_static_prefix(prompt: str) -> Tuple[str, str]:
+        """Splits a build_qa_prompt prompt into its header and the rest.
+
+        The header is fixed by role, strategy and examples, and every strategy
+        places the document context after it, so it ends where "CONTEXT:"
+        starts. Only meaningful for prompts this class built; user-edited
+        prompts have no trustworthy header.
+        """
+        position = prompt.find("CONTEXT:")
+        if position <= 0:
+            return "", prompt
+        return prompt[:position], prompt[position:]
+
     @staticmethod
     def extract_confidence(response: str) -> float:
         """Extract confidence score from response if present."""
@@ -407,24 +2243,342 @@ COMPLETE ANSWER:"""
 
 """### 🔄 Part 7: Self-Consistency and Response Generation"""
 
-def generate_with_self_consistency(prompt: str, generator_pipeline, num_samples: int = 3) -> Tuple[str, float, List[str]]:
+@lru_cache(maxsize=None)
+def _stop_on_markers_class():
+    """Defined on first use so transformers is only imported along with the models."""
+
+    class StopOnMarkers(transformers.StoppingCriteria):
+        """Stops each sequence once its generated text contains a stop marker."""
+
+        def __init__(self, tokenizer, markers, window=STOP_MARKER_WINDOW):
+            self.tokenizer = tokenizer
+            self.markers = markers
+            self.window = window
+            self.prompt_length = None
+
+        def __call__(self, input_ids, scores, **kwargs):
+            # First called after one new token, which reveals the prompt length
+            if self.prompt_length is None:
+                self.prompt_length = input_ids.shape[1] - 1
+            start = max(self.prompt_length, input_ids.shape[1] - self.window)
+            tails = self.tokenizer.batch_decode(input_ids[:, start:], skip_special_tokens=True)
+            return torch.tensor([any(marker in tail for marker in self.markers) for tail in tails],
+                                dtype=torch.bool, device=input_ids.device)
+
+    return StopOnMarkers
+
+def _eos_token_ids() -> List[int]:
+    """EOS plus chat end-of-turn tokens the model emits when it considers the answer done."""
+    eos_ids = [tokenizer.eos_token_id]
+    end_of_turn = tokenizer.convert_tokens_to_ids("<end_of_turn>")
+    if end_of_turn is not None and end_of_turn != tokenizer.unk_token_id:
+        eos_ids.append(end_of_turn)
+    return eos_ids
+
+def with_stopping(generate_kwargs: Dict) -> Dict:
+    """Adds fresh stop-marker criteria and end-of-turn EOS tokens to generation kwargs.
+
+    Criteria keep per-call state, so this is applied right before each
+    pipeline or generate call rather than stored in shared kwargs.
+    """
+    if not STOP_MARKERS or "stopping_criteria" in generate_kwargs:
+        return generate_kwargs
+    criteria = transformers.StoppingCriteriaList([_stop_on_markers_class()(tokenizer, STOP_MARKERS)])
+    return {"eos_token_id": _eos_token_ids(), **generate_kwargs, "stopping_criteria": criteria}
+
+def truncate_at_stop_markers(text: str) -> str:
+    """Cuts a response at the first stop marker the model produced before stopping."""
+    positions = [text.find(marker) for marker in STOP_MARKERS]
+    positions = [position for position in positions if position >= 0]
+    return text[:min(positions)].rstrip() if positions else text
+
+class DirectGenerator:
+    """Pipeline-compatible generation that decodes only the new token IDs.
+
+    The text-generation pipeline decodes the whole sequence and then the
+    prompt again to cut it off, even with return_full_text=False. This
+    calls model.generate on a left-padded batch and decodes just the
+    tokens after the prompt. Returns one list of {"generated_text": ...}
+    dicts per prompt, like the pipeline.
+    """
+
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+
+    def __call__(self, prompts, batch_size=None, **generate_kwargs):
+        single = isinstance(prompts, str)
+        batch = [prompts] if single else list(prompts)
+        kwargs = {**GENERATION_DEFAULTS, **generate_kwargs}
+        num_sequences = kwargs.pop("num_return_sequences", 1)
+        kwargs.pop("return_full_text", None)
+        kwargs.pop("prompt_header", None)  # Only used by PrefixKVCache
+
+        encoded = self.tokenizer(batch, return_tensors="pt", padding=True).to(self.model.device)
+        with torch.no_grad():
+            output_ids = self.model.generate(**encoded, num_return_sequences=num_sequences,
+                                             pad_token_id=self.tokenizer.pad_token_id, **kwargs)
+        completions = self.tokenizer.batch_decode(output_ids[:, encoded["input_ids"].shape[1]:],
+                                                  skip_special_tokens=True)
+        outputs = [[{"generated_text": completion}
+                    for completion in completions[i * num_sequences:(i + 1) * num_sequences]]
+                   for i in range(len(batch))]
+        return outputs[0] if single else outputs
+
+class PrefixKVCache:
+    """Resumes generation from cached key/values of shared prompt headers.
+
+    Callers that built the prompt with PromptBuilder pass its header as
+    prompt_header (see PromptBuilder.split_static_prefix); it is prefilled
+    once and its past key/values kept in an LRU cache. Later prompts with
+    the same header copy them and prefill only the context and question.
+    Prompts without a header, such as user-edited ones, are never cached.
+
+    Called like the pipeline and returns the same output format; batches of
+    several prompts go to the wrapped DirectGenerator unchanged, because
+    their headers and lengths differ.
+    """
+
+    def __init__(self, generator, maxsize: int = PREFIX_CACHE_SIZE):
+        self.generator = generator
+        self.model = generator.model
+        self.tokenizer = generator.tokenizer
+        self.entries = LRUCache(maxsize)
+        self.prefill_tokens = 0
+        self.prefill_tokens_saved = 0
+
+    def __call__(self, prompts, batch_size=None, **generate_kwargs):
+        if isinstance(prompts, str):
+            return self.generate(prompts, **generate_kwargs)
+        if len(prompts) == 1:
+            return [self.generate(prompts[0], **generate_kwargs)]
+        return self.generator(prompts, batch_size=batch_size, **generate_kwargs)
+
+    def _prefix_state(self, prefix: str):
+        """(prefix token IDs, past key/values, cache hit) for a header."""
+        entry = self.entries.get(prefix)
+        if entry is not None:
+            return entry + (True,)
+        prefix_ids = self.tokenizer(prefix, return_tensors="pt").input_ids.to(self.model.device)
+        with torch.no_grad():
+            past = self.model(prefix_ids, use_cache=True).past_key_values
+        self.entries.put(prefix, (prefix_ids, past))
+        return prefix_ids, past, False
+
+    def generate(self, prompt: str, prompt_header: Optional[str] = None, **generate_kwargs):
+        """Same result as the wrapped generator: one dict per returned sequence."""
+        num_sequences = generate_kwargs.get("num_return_sequences", 1)
+        if not prompt_header or not prompt.startswith(prompt_header):
+            return self.generator(prompt, **generate_kwargs)
+        prefix, rest = prompt_header, prompt[len(prompt_header):]
+
+        prefix_ids, prefix_past, hit = self._prefix_state(prefix)
+        if num_sequences > 1 and not hasattr(prefix_past, "batch_repeat_interleave"):
+            # Legacy tuple caches cannot be expanded to several sequences
+            return self.generator(prompt, **generate_kwargs)
+        rest_ids = self.tokenizer(rest, add_special_tokens=False, return_tensors="pt").input_ids
+        input_ids = torch.cat([prefix_ids, rest_ids.to(prefix_ids.device)], dim=1)
+        self.prefill_tokens += input_ids.shape[1]
+        if hit:
+            self.prefill_tokens_saved += prefix_ids.shape[1]
+
+        # generate() extends the cache in place, so each request gets its own copy
+        past = copy.deepcopy(prefix_past)
+        kwargs = {**GENERATION_DEFAULTS, **generate_kwargs}
+        kwargs.pop("num_return_sequences", None)
+        kwargs.pop("return_full_text", None)
+        if num_sequences > 1:
+            past.batch_repeat_interleave(num_sequences)
+            input_ids = input_ids.repeat(num_sequences, 1)
+
+        with torch.no_grad():
+            output_ids = self.model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                                             past_key_values=past, pad_token_id=self.tokenizer.pad_token_id,
+                                             **kwargs)
+        completions = self.tokenizer.batch_decode(output_ids[:, input_ids.shape[1]:], skip_special_tokens=True)
+        return [{"generated_text": completion} for completion in completions]
+
+    def stats(self) -> Dict:
+        entry_stats = self.entries.stats()
+        return {
+            "headers": entry_stats["size"],
+            "hits": entry_stats["hits"],
+            "misses": entry_stats["misses"],
+            "prefill_tokens": self.prefill_tokens,
+            "prefill_tokens_saved": self.prefill_tokens_saved,
+            "saved_fraction": self.prefill_tokens_saved / self.prefill_tokens if self.prefill_tokens else 0.0,
+        }
+
+def benchmark_prefix_cache(prompts, repeats: int = 3) -> Dict:
+    """Time-to-first-token of the plain pipeline vs resuming from a cached header.
+
+    Each prompt generates a single token, so the time is dominated by prefill.
+    """
+    cache = PrefixKVCache(DirectGenerator(text_generator.model, tokenizer))
+    headers = [PromptBuilder.split_static_prefix(prompt)[0] for prompt in prompts]
+    for prompt, header in zip(prompts, headers):
+        cache.generate(prompt, prompt_header=header, max_new_tokens=1)  # Populate the header cache
+
+    timings = {}
+    runs = (("pipeline", lambda prompt, header, **kwargs: text_generator(prompt, **kwargs)),
+            ("prefix cache", lambda prompt, header, **kwargs: cache.generate(prompt, header, **kwargs)))
+    for label, generate in runs:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for prompt, header in zip(prompts, headers):
+                generate(prompt, header, max_new_tokens=1, do_sample=False)
+        timings[label] = (time.perf_counter() - start) * 1000 / (repeats * len(prompts))
+        print(f"{label:<13} TTFT {timings[label]:7.1f} ms")
+    stats = cache.stats()
+    print(f"Prefill tokens saved: {stats['prefill_tokens_saved']}/{stats['prefill_tokens']} "
+          f"({stats['saved_fraction']:.0%}); TTFT speedup {timings['pipeline'] / timings['prefix cache']:.2f}x")
+    return {"ttft_ms": timings, **stats}
+
+class GenerationScheduler:
+    """Groups concurrent prompts into dynamic batches for the shared pipeline.
+
+    Callers submit a prompt and get a Future. A worker thread takes the
+    oldest prompt, waits up to max_wait_ms for more to arrive (up to
+    max_batch_size), and runs each group of prompts with identical
+    generation arguments as one batched pipeline call. Requests carrying a
+    streamer run on their own, since a streamer follows one sequence, but
+    still on the worker, so the worker is the only thread using the model.
+    Calling the scheduler like the pipeline blocks for that prompt's
+    result, so it is a drop-in replacement for text_generator.
+    """
+
+    def __init__(self, generator_pipeline, max_batch_size: int = GENERATION_MAX_BATCH_SIZE,
+                 max_wait_ms: float = GENERATION_MAX_WAIT_MS):
+        self.generator_pipeline = generator_pipeline
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batches = 0
+        self.requests = 0
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="generation-scheduler", daemon=True)
+        self._worker.start()
+
+    def submit(self, prompt: str, **generate_kwargs) -> Future:
+        future = Future()
+        self._queue.put((prompt, generate_kwargs, future))
+        return future
+
+    def __call__(self, prompt: str, **generate_kwargs):
+        return self.submit(prompt, **generate_kwargs).result()
+
+    def close(self):
+        """Stops the worker once the prompts already queued are done."""
+        self._queue.put(None)
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        if batch[0] is None:
+            return None
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)  # Stop after this batch
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                return
+            groups = defaultdict(list)
+            for request in batch:
+                if "streamer" in request[1]:
+                    groups[id(request)].append(request)
+                else:
+                    groups[json.dumps(request[1], sort_keys=True, default=str)].append(request)
+
+            for requests in groups.values():
+                prompts = [prompt for prompt, _, _ in requests]
+                generate_kwargs = with_stopping(requests[0][1])
+                try:
+                    if "streamer" in generate_kwargs:
+                        outputs = [self.generator_pipeline(prompts[0], **generate_kwargs)]
+                    else:
+                        outputs = self.generator_pipeline(prompts, batch_size=len(prompts), **generate_kwargs)
+                except Exception as e:
+                    for _, _, future in requests:
+                        future.set_exception(e)
+                    continue
+                self.batches += 1
+                self.requests += len(requests)
+                for (_, _, future), output in zip(requests, outputs):
+                    future.set_result(output)
+
+    def stats(self) -> Dict:
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "queued": self._queue.qsize(),
+        }
+
+def benchmark_generation_scheduler(prompts, concurrency=(1, 4, 8), max_new_tokens=64,
+                                   max_batch_sizes=(1, GENERATION_MAX_BATCH_SIZE),
+                                   max_wait_ms=GENERATION_MAX_WAIT_MS):
+    """Throughput and latency of the scheduler under simulated concurrent users.
+
+    Each of `users` threads submits prompts back to back; max_batch_size=1
+    is the unbatched baseline. Reports requests/sec and p50/p95 latency.
+    """
+    results = []
+    for max_batch_size in max_batch_sizes:
+        for users in concurrency:
+            scheduler = GenerationScheduler(text_generator, max_batch_size, max_wait_ms)
+
+            def request(prompt):
+                start = time.perf_counter()
+                scheduler(prompt, max_new_tokens=max_new_tokens)
+                return time.perf_counter() - start
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=users) as pool:
+                latencies = sorted(pool.map(request, prompts))
+            elapsed = time.perf_counter() - start
+            scheduler.close()
+            row = {
+                "max_batch_size": max_batch_size,
+                "users": users,
+                "requests_per_sec": len(prompts) / elapsed,
+                "p50_ms": latencies[len(latencies) // 2] * 1000,
+                "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+                "mean_batch_size": scheduler.stats()["mean_batch_size"],
+            }
+            print(f"batch<={max_batch_size:<3} users={users:<3} {row['requests_per_sec']:6.2f} req/s  "
+                  f"p50 {row['p50_ms']:7.0f} ms  p95 {row['p95_ms']:7.0f} ms  "
+                  f"mean batch {row['mean_batch_size']:.1f}")
+            results.append(row)
+    return results
+
+def generate_with_self_consistency(prompt: str, generator_pipeline, num_samples: int = 3,
+                                   **generate_kwargs) -> Tuple[str, float, List[str]]:
     """Generate multiple responses and select the best one."""
 
     if num_samples == 1:
         # Standard single generation
-        outputs = generator_pipeline(prompt)
-        response = outputs[0]['generated_text'].split("ANSWER:")[-1].strip()
+        outputs = generator_pipeline(prompt, **generate_kwargs)
+        response = truncate_at_stop_markers(outputs[0]['generated_text'].strip())
         confidence = PromptBuilder.extract_confidence(response)
         return response, confidence, [response]
 
-    # Generate multiple responses
-    responses = []
-    for i in range(num_samples):
-        outputs = generator_pipeline(prompt, temperature=0.7 + i*0.1)  # Vary temperature
-        response = outputs[0]['generated_text'].split("ANSWER:")[-1].strip()
-        if "COMPLETE ANSWER:" in response:
-            response = response.split("COMPLETE ANSWER:")[-1].strip()
-        responses.append(response)
+    # Draw every sample in one call so the prompt is encoded once and the
+    # samples decode as a batch
+    outputs = generator_pipeline(prompt, num_return_sequences=num_samples, do_sample=True,
+                                 temperature=SELF_CONSISTENCY_TEMPERATURE, **generate_kwargs)
+    responses = [truncate_at_stop_markers(output['generated_text'].strip()) for output in outputs]
 
     # Simple voting mechanism - find common themes
     # For a more sophisticated approach, you could use semantic similarity
@@ -454,13 +2608,104 @@ def generate_with_self_consistency(prompt: str, generator_pipeline, num_samples:
 
     return best_response, base_confidence, responses
 
+def benchmark_self_consistency(prompt: str, num_samples: int = 3, max_new_tokens: int = 128,
+                               repeats: int = 3) -> Dict:
+    """Compares sequential per-sample generation with one batched num_return_sequences call."""
+    def sequential():
+        for i in range(num_samples):
+            text_generator(prompt, max_new_tokens=max_new_tokens, temperature=0.7 + i * 0.1)
+
+    def batched():
+        text_generator(prompt, max_new_tokens=max_new_tokens, num_return_sequences=num_samples,
+                       do_sample=True, temperature=SELF_CONSISTENCY_TEMPERATURE)
+
+    timings = {}
+    for label, run in (("sequential", sequential), ("batched", batched)):
+        run()  # Warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            run()
+        timings[label] = (time.perf_counter() - start) / repeats
+        print(f"{label:<10} {timings[label]:6.2f} s per {num_samples} samples")
+    timings["speedup"] = timings["sequential"] / timings["batched"]
+    print(f"Speedup: {timings['speedup']:.2f}x")
+    return timings
+
+
+class ResponseCache(LRUCache):
+    """LRU cache of generated responses with TTL and optional JSON persistence."""
+
+    def __init__(self, maxsize: int = RESPONSE_CACHE_SIZE, ttl: Optional[float] = RESPONSE_CACHE_TTL,
+                 path: Optional[str] = RESPONSE_CACHE_PATH):
+        super().__init__(maxsize, ttl)
+        self.path = path
+        self._save_lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def put(self, key, value, expires_at: Optional[float] = None):
+        super().put(key, value, expires_at)
+        if self.path:
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except Exception as e:
+            print(f"Error loading response cache: {e}")
+            return
+        now = time.time()
+        for key, value, expires_at in entries:
+            if expires_at is None or expires_at > now:
+                super().put(key, value, expires_at)
+        print(f"Loaded {len(self)} cached responses from {self.path}")
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with self._save_lock:
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(self.items(), f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                print(f"Error saving response cache: {e}")
+
+response_cache = None  # Created by main(), which loads RESPONSE_CACHE_PATH
+
+def response_cache_key(query: str, context: str, role: str, strategy: str,
+                       custom_examples: Optional[List[Dict]], num_samples: int) -> str:
+    """Hashes everything that determines a generated response.
+
+    The retrieved context stands in for the document: it changes whenever
+    the document, the document filter or the relevance cutoff does.
+    """
+    params = {
+        "model": LLM_MODEL_NAME,
+        "query": normalize_query(query),
+        "context": hashlib.sha256(context.encode("utf-8")).hexdigest(),
+        "role": role,
+        "strategy": strategy,
+        "examples": custom_examples,
+        "generation": GENERATION_DEFAULTS,
+        "max_new_tokens": STRATEGY_MAX_NEW_TOKENS.get(strategy),
+        "num_samples": num_samples,
+        "temperature": SELF_CONSISTENCY_TEMPERATURE if num_samples > 1 else None,
+        "stop_markers": STOP_MARKERS,
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _response_cache_enabled(num_samples: int) -> bool:
+    sampled = GENERATION_DEFAULTS["do_sample"] or num_samples > 1
+    return response_cache is not None and (RESPONSE_CACHE_SAMPLED or not sampled)
 
 def generate_response(query: str, context: str, task: str, role: str,
                              strategy: str, custom_examples: Optional[List[Dict]] = None,
                              use_self_consistency: bool = False) -> Dict:
     """Generate response with selected strategies."""
 
-    if text_generator is None:
+    if generation_scheduler is None:
         return {
             "response": "Error: Text generator not initialized.",
             "confidence": 0.0,
@@ -476,18 +2721,31 @@ def generate_response(query: str, context: str, task: str, role: str,
             # For now, focusing on QA. Can extend to other tasks
             prompt = PromptBuilder.build_qa_prompt(role, query, context, strategy, custom_examples)
 
-        # Generate response(s)
+        # Reuse the response to an identical request
         num_samples = 3 if use_self_consistency else 1
+        use_cache = _response_cache_enabled(num_samples)
+        if use_cache:
+            cache_key = response_cache_key(query, context, role, strategy, custom_examples, num_samples)
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                return {**cached, "cached": True}
+
+        # Generate response(s)
         response, confidence, all_responses = generate_with_self_consistency(
-            prompt, text_generator, num_samples
+            prompt, generation_scheduler, num_samples,
+            max_new_tokens=STRATEGY_MAX_NEW_TOKENS.get(strategy, GENERATION_DEFAULTS["max_new_tokens"]),
+            prompt_header=PromptBuilder.split_static_prefix(prompt)[0]
         )
 
-        return {
+        result = {
             "response": response,
             "confidence": confidence,
             "prompt_used": prompt,
             "all_responses": all_responses
         }
+        if use_cache:
+            response_cache.put(cache_key, result)
+        return result
 
     except Exception as e:
         print(f"Error generating response: {e}")
@@ -498,9 +2756,85 @@ def generate_response(query: str, context: str, task: str, role: str,
             "all_responses": []
         }
 
+def stream_generation(prompt: str, **generate_kwargs):
+    """Yields the completion of prompt (new text only) as it grows, token by token.
+
+    The request goes through the generation scheduler with a
+    TextIteratorStreamer, so each update is available as soon as it is
+    decoded while the model is only ever driven by the scheduler's worker.
+    """
+    streamer = transformers.TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    future = generation_scheduler.submit(prompt, streamer=streamer, **generate_kwargs)
+
+    def unblock_on_error(done):
+        if done.exception() is not None:
+            streamer.end()  # Unblock the consumer
+
+    future.add_done_callback(unblock_on_error)
+    completion = ""
+    for text in streamer:
+        completion += text
+        yield completion
+    future.result()  # Re-raises a generation error
+
+def generate_response_stream(query: str, context: str, role: str, strategy: str,
+                             custom_examples: Optional[List[Dict]] = None):
+    """Streaming counterpart of generate_response (single sample).
+
+    Yields the partial response while generating, then the same result dict
+    as generate_response plus the time to first token. A cached response is
+    yielded directly as the result dict.
+    """
+    use_cache = _response_cache_enabled(1)
+    if use_cache:
+        cache_key = response_cache_key(query, context, role, strategy, custom_examples, 1)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            yield {**cached, "cached": True}
+            return
+
+    prompt = PromptBuilder.build_qa_prompt(role, query, context, strategy, custom_examples)
+    start = time.perf_counter()
+    first_token_ms = None
+    completion = ""
+    max_new_tokens = STRATEGY_MAX_NEW_TOKENS.get(strategy, GENERATION_DEFAULTS["max_new_tokens"])
+    for completion in stream_generation(prompt, max_new_tokens=max_new_tokens,
+                                        prompt_header=PromptBuilder.split_static_prefix(prompt)[0]):
+        if first_token_ms is None:
+            first_token_ms = (time.perf_counter() - start) * 1000
+        yield truncate_at_stop_markers(completion.strip())
+
+    response = truncate_at_stop_markers(completion.strip())
+    result = {
+        "response": response,
+        "confidence": PromptBuilder.extract_confidence(response),
+        "prompt_used": prompt,
+        "all_responses": [response],
+    }
+    if use_cache:
+        response_cache.put(cache_key, result)
+    yield {**result, "first_token_ms": first_token_ms}
+
+def benchmark_streaming_ttft(prompt: str, max_new_tokens: int = 200, repeats: int = 3) -> Dict:
+    """Time until the user sees text: blocking generation vs the first streamed update."""
+    blocking, streamed = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        generation_scheduler(prompt, max_new_tokens=max_new_tokens)
+        blocking.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in stream_generation(prompt, max_new_tokens=max_new_tokens):
+            streamed.append(time.perf_counter() - start)
+            break
+    result = {"blocking_ms": float(np.mean(blocking)) * 1000, "first_token_ms": float(np.mean(streamed)) * 1000}
+    print(f"Blocking: {result['blocking_ms']:.0f} ms to first text; "
+          f"streaming: {result['first_token_ms']:.0f} ms")
+    return result
+
 """### 📊 Part 8: Visualization and Analysis Functions"""
 
-def create_confidence_gauge(confidence: float) -> go.Figure:
+def create_confidence_gauge(confidence: float) -> "go.Figure":
     """Create a confidence gauge visualization."""
 
     fig = go.Figure(go.Indicator(
@@ -538,6 +2872,17 @@ def create_confidence_gauge(confidence: float) -> go.Figure:
     return fig
 
 
+def format_sources(retrieved: List[RetrievedChunk], corpus: DocumentCorpus) -> str:
+    """List the chunks used as context with their scores and positions."""
+    sources = "**Sources**:\n"
+    for chunk in retrieved:
+        name = corpus.documents.get(chunk.doc_id, {}).get("name", "document")
+        position = f", chars {chunk.offsets[0]}–{chunk.offsets[1]}" if chunk.offsets else ""
+        keyword = f" · bm25 {chunk.bm25_score:.1f}" if chunk.bm25_score else ""
+        sources += f"- {name} · chunk {chunk.chunk_id}{position} · score {chunk.score:.2f}{keyword}\n"
+    return sources
+
+
 def compare_responses(responses_dict: Dict[str, Dict]) -> str:
     """Create a comparison of different strategy responses."""
 
@@ -555,9 +2900,7 @@ def compare_responses(responses_dict: Dict[str, Dict]) -> str:
 
 # Document state management
 document_state = {
-    "file_path": None,
-    "vector_store": None,
-    "indexed_chunks": None
+    "corpus": DocumentCorpus()
 }
 
 # Example library management
@@ -568,36 +2911,128 @@ custom_examples = {
 }
 
 
-def process_document(file_obj):
-    """Process uploaded document."""
-    global document_state
-
-    if file_obj is None:
-        return "Please upload a PDF document.", ""
-
-    current_file_path = file_obj.name
-
-    if current_file_path != document_state.get("file_path"):
-        chunks = load_and_chunk_pdf(current_file_path)
-        if chunks is None:
-            return "Error: Failed to load PDF.", ""
-
-        vector_store, indexed_chunks = build_vector_store(chunks, embedder)
-        if vector_store is None:
-            return "Error: Failed to build vector store.", ""
-
-        document_state["file_path"] = current_file_path
-        document_state["vector_store"] = vector_store
-        document_state["indexed_chunks"] = indexed_chunks
-
-        preview = f"Document processed successfully!\n\n"
-        preview += f"📄 File: {os.path.basename(current_file_path)}\n"
-        preview += f"📊 Chunks: {len(chunks)}\n"
-        preview += f"📝 Preview: {chunks[0][:200]}..."
+def _chunk_document(file_path):
+    """Streams a PDF's (chunk, span) pairs, deduplicated when enabled."""
+    chunk_stream = iter_pdf_chunks(file_path)
+    deduplicator = ChunkDeduplicator() if DEDUP_CHUNKS else None
+    if deduplicator is not None:
+        chunk_stream = deduplicator.filter(chunk_stream)
+    return chunk_stream, deduplicator
+
+def index_document(file_path):
+    """Adds one PDF to the corpus; returns (doc_id, chunks, status).
+
+    Documents are identified by file name, so uploading a revised version of
+    a loaded PDF updates it in place and only re-embeds the changed chunks.
+    """
+    corpus = document_state["corpus"]
+    doc_id = os.path.basename(file_path)
+    doc_key = compute_document_key(file_path)
+    existing = corpus.documents.get(doc_id)
+    if existing is not None and existing["content_key"] == doc_key:
+        return doc_id, None, "already loaded"
+
+    # Reuse a persisted index for identical bytes and chunking settings
+    vector_store, chunks, chunk_offsets = load_vector_store(doc_key)
+    if vector_store is not None:
+        corpus.add_document(doc_id, doc_id, chunks, index_vectors(vector_store),
+                            chunk_offsets, content_key=doc_key)
+        return doc_id, chunks, "loaded from vector store cache"
+
+    print(f"Loading PDF: {file_path}")
+    chunk_stream, deduplicator = _chunk_document(file_path)
+
+    if existing is not None:
+        # Revised upload: diff chunk hashes against the loaded version
+        pairs = list(chunk_stream)
+        if not pairs:
+            return None, None, "no chunks extracted"
+        chunks = [text for text, _ in pairs]
+        chunk_offsets = [span for _, span in pairs]
+        counts = corpus.update_document(doc_id, doc_id, chunks, chunk_offsets,
+                                        lambda texts: embed_texts(texts, embedder),
+                                        content_key=doc_key)
+        # Raw vectors come back from the embedding cache; the corpus copy may be quantized
+        if embedding_cache is not None:
+            vectors = embed_texts(chunks, embedder)
+            if VECTOR_METRIC == "cosine":
+                faiss.normalize_L2(vectors)
+        else:
+            vectors = corpus.document_vectors(doc_id)
+        vector_store = create_faiss_index(vectors, "flat", storage="float32")
+        vector_store.add(vectors)
+        save_vector_store(doc_key, vector_store, chunks, chunk_offsets)
+        status = (f"updated: {counts['added']} chunks re-embedded, {counts['kept']} unchanged, "
+                  f"{counts['removed']} removed")
+        print(f"Incremental re-index of {doc_id}: {status}")
+        return doc_id, chunks, status
+
+    # Pages are parsed, chunked, deduplicated and embedded as a single stream
+    build_stats = {}
+    # The persisted store keeps raw float32 vectors; the corpus picks its own engine
+    vector_store, chunks, chunk_offsets = build_vector_store(chunk_stream, embedder, index_type="flat",
+                                                             stats=build_stats, storage="float32")
+    if vector_store is None:
+        return None, None, "failed to build vector store"
+    save_vector_store(doc_key, vector_store, chunks, chunk_offsets)
+    status = "indexed"
+    if deduplicator is not None:
+        status += "; " + deduplicator.summary(build_stats["embedding_seconds"] / len(chunks))
+        print(f"Deduplication: {status}")
+
+    corpus.add_document(doc_id, doc_id, chunks, index_vectors(vector_store),
+                        chunk_offsets, content_key=doc_key)
+    return doc_id, chunks, status
 
-        return "Document ready for analysis!", preview
 
-    return "Using previously processed document.", "Document already loaded."
+def process_document(file_obj):
+    """Process uploaded document(s) and add them to the shared corpus."""
+    corpus = document_state["corpus"]
+
+    if not file_obj:
+        return "Please upload a PDF document.", "", gr.update()
+
+    error = ensure_models_loaded(need_llm=False)
+    if error:
+        return f"Error: {error}", "", gr.update()
+
+    file_objs = file_obj if isinstance(file_obj, list) else [file_obj]
+    preview = ""
+    ready = 0
+    for f in file_objs:
+        file_path = f.name
+        name = os.path.basename(file_path)
+        if not os.path.exists(file_path):
+            preview += f"❌ {name}: failed to load PDF\n"
+            continue
+
+        doc_id, chunks, status = index_document(file_path)
+        if doc_id is None:
+            preview += f"❌ {name}: {status}\n"
+            continue
+
+        ready += 1
+        preview += f"📄 {name}: {status}"
+        if chunks:
+            preview += f" ({len(chunks)} chunks)\n📝 Preview: {chunks[0][:200]}..."
+        preview += "\n\n"
+
+    preview += corpus.summary()
+    if embedding_cache is not None:
+        preview += "\n" + embedding_cache.summary()
+    status_message = "Document ready for analysis!" if ready else "Error: Failed to load PDF."
+    return status_message, preview, gr.update(choices=corpus.document_choices())
+
+
+def remove_documents(doc_ids):
+    """Remove the selected documents from the corpus."""
+    corpus = document_state["corpus"]
+    if not doc_ids:
+        return "Select documents to remove.", gr.update()
+
+    removed = sum(corpus.remove_document(doc_id) for doc_id in doc_ids)
+    return (f"Removed {len(doc_ids)} document(s), {removed} chunks.\n{corpus.summary()}",
+            gr.update(choices=corpus.document_choices(), value=[]))
 
 
 def add_custom_example(role, query, response):
@@ -628,31 +3063,51 @@ def preview_prompt(role, query, strategy, use_examples):
 
 
 def run_analysis(file_obj, role, query, strategy, use_self_consistency,
-                use_custom_examples, compare_strategies):
-    """Main analysis function."""
+                use_custom_examples, compare_strategies, selected_docs=None,
+                min_score=RETRIEVAL_MIN_SCORE):
+    """Main analysis function.
+
+    A generator, so Gradio shows the response while it is being written
+    (single strategy without self-consistency); other modes yield once.
+    """
 
     # Check models
-    if embedder is None or text_generator is None:
-        return "Error: Models not loaded.", "", None
+    error = ensure_models_loaded()
+    if error:
+        yield f"Error: {error}", "", None
+        return
 
     # Check document
-    if document_state["vector_store"] is None:
-        return "Please upload and process a document first.", "", None
+    corpus = document_state["corpus"]
+    if len(corpus) == 0:
+        yield "Please upload and process a document first.", "", None
+        return
 
     if not query:
-        return "Please enter a query.", "", None
+        yield "Please enter a query.", "", None
+        return
 
     # Retrieve context
-    context = retrieve_context(
-        query,
-        document_state["vector_store"],
-        embedder,
-        document_state["indexed_chunks"],
-        top_k=3
-    )
+    try:
+        retrieved = retrieve_chunks(
+            query,
+            corpus,
+            embedder,
+            corpus.chunks,
+            top_k=RETRIEVAL_TOP_K,
+            doc_ids=selected_docs,
+            min_score=min_score
+        )
+    except Exception as e:
+        print(f"Error during retrieval: {e}")
+        yield f"Error retrieving context: {e}", "", None
+        return
 
-    if "Error" in context:
-        return f"Error retrieving context: {context}", "", None
+    if not retrieved:
+        yield "Could not find context above the relevance cutoff. Try lowering it.", "", None
+        return
+    context = format_context(retrieved)
+    sources = format_sources(retrieved, corpus)
 
     # Generate response(s)
     if compare_strategies:
@@ -669,24 +3124,45 @@ def run_analysis(file_obj, role, query, strategy, use_self_consistency,
 
         # Use the selected strategy's response as main
         main_result = responses_dict[strategy]
-        comparison = compare_responses(responses_dict)
+        comparison = compare_responses(responses_dict) + sources
 
-        return main_result["response"], comparison, create_confidence_gauge(main_result["confidence"])
+        yield main_result["response"], comparison, create_confidence_gauge(main_result["confidence"])
 
     else:
         # Single strategy
-        result = generate_response(
-            query, context, "Ask a question", role, strategy,
-            custom_examples[role] if use_custom_examples else None,
-            use_self_consistency
-        )
+        examples = custom_examples[role] if use_custom_examples else None
+        if STREAM_RESPONSES and not use_self_consistency:
+            try:
+                for result in generate_response_stream(query, context, role, strategy, examples):
+                    if isinstance(result, str):
+                        yield result, "", None
+            except Exception as e:
+                print(f"Error generating response: {e}")
+                yield f"Error: {str(e)}", "", None
+                return
+        else:
+            result = generate_response(
+                query, context, "Ask a question", role, strategy, examples,
+                use_self_consistency
+            )
 
         details = f"**Strategy**: {strategy}\n"
         details += f"**Confidence**: {result['confidence']:.2%}\n"
+        if result.get("cached"):
+            details += "**Response Cache**: served from cache\n"
+        elif result.get("first_token_ms") is not None:
+            details += f"**Time to First Token**: {result['first_token_ms']:.0f} ms\n"
         if use_self_consistency and len(result['all_responses']) > 1:
             details += f"\n**Self-Consistency**: Generated {len(result['all_responses'])} responses\n"
+        cache_stats = query_embedding_cache.stats()
+        details += f"\n**Query Cache**: {cache_stats['hits']} hits / {cache_stats['misses']} misses\n"
+        if prefix_cache is not None:
+            prefix_stats = prefix_cache.stats()
+            details += (f"\n**Prompt Prefix Cache**: {prefix_stats['prefill_tokens_saved']} prefill tokens saved "
+                        f"({prefix_stats['saved_fraction']:.0%})\n")
+        details += f"\n{sources}"
 
-        return result["response"], details, create_confidence_gauge(result["confidence"])
+        yield result["response"], details, create_confidence_gauge(result["confidence"])
 
 
 def edit_and_regenerate(edited_prompt):
@@ -694,14 +3170,20 @@ def edit_and_regenerate(edited_prompt):
     if not edited_prompt:
         return "Please provide a prompt.", None
 
+    error = ensure_models_loaded()
+    if error:
+        return f"Error: {error}", None
+
     try:
-        outputs = text_generator(edited_prompt)
-        response = outputs[0]['generated_text'].split(edited_prompt)[-1].strip()
+        outputs = generation_scheduler(edited_prompt)
+        response = outputs[0]['generated_text'].strip()
 
-        # Clean up common markers
-        for marker in ["ANSWER:", "RESPONSE:", "COMPLETE ANSWER:"]:
-            if marker in response:
-                response = response.split(marker)[-1].strip()
+        # Clean up a marker the model repeats at the start of its answer
+        response = truncate_at_stop_markers(response)
+        for marker in ["COMPLETE ANSWER:", "ANSWER:", "RESPONSE:"]:
+            if response.startswith(marker):
+                response = response.removeprefix(marker).lstrip()
+                break
 
         confidence = PromptBuilder.extract_confidence(response)
         return response, create_confidence_gauge(confidence)
@@ -711,9 +3193,6 @@ def edit_and_regenerate(edited_prompt):
 
 """### 🚀 Part 10: Launch Ultra-Smart-AI Interface"""
 
-# Create the Gradio interface
-print("Building Ultra-Smart-AI Interface with Multi-Strategy Support...")
-
 # Custom CSS
 custom_css = """
 .strategy-box {
@@ -735,192 +3214,245 @@ custom_css = """
 }
 """
 
-with gr.Blocks(css=custom_css, title="Ultra-Smart AI Assistant", theme=gr.themes.Soft()) as demo:
+def build_demo():
+    """Builds the Gradio UI; called from main() so spawned worker processes skip it."""
+    print("Building Ultra-Smart-AI Interface with Multi-Strategy Support...")
 
-    gr.Markdown(
-        """
-        # 🚀 Ultra-Smart Document Helper
-        ### Combining Multiple Advanced Prompting Strategies
+    with gr.Blocks(css=custom_css, title="Ultra-Smart AI Assistant", theme=gr.themes.Soft()) as demo:
 
-        **Features**: Role-Based Prompting + Few-Shot Learning + Chain-of-Thought + Self-Consistency + Interactive Editing
-        """
-    )
+        gr.Markdown(
+            """
+            # 🚀 Ultra-Smart Document Helper
+            ### Combining Multiple Advanced Prompting Strategies
 
-    with gr.Tabs():
-        # Main Analysis Tab
-        with gr.Tab("📊 Document Analysis"):
-            with gr.Row():
-                with gr.Column(scale=1):
-                    file_input = gr.File(label="📄 Upload PDF", file_types=[".pdf"])
-                    process_btn = gr.Button("Process Document", variant="primary")
-                    doc_status = gr.Textbox(label="Status", lines=2)
-                    doc_preview = gr.Textbox(label="Document Preview", lines=4)
-
-                    gr.Markdown("### 🎯 Configuration")
-                    role_select = gr.Dropdown(
-                        label="🎭 AI Role",
-                        choices=list(ROLES.keys()),
-                        value="Teacher"
-                    )
+            **Features**: Role-Based Prompting + Few-Shot Learning + Chain-of-Thought + Self-Consistency + Interactive Editing
+            """
+        )
+        model_status = gr.Markdown(model_status_message())
+
+        with gr.Tabs():
+            # Main Analysis Tab
+            with gr.Tab("📊 Document Analysis"):
+                with gr.Row():
+                    with gr.Column(scale=1):
+                        file_input = gr.File(label="📄 Upload PDF", file_types=[".pdf"], file_count="multiple")
+                        process_btn = gr.Button("Process Document", variant="primary")
+                        doc_status = gr.Textbox(label="Status", lines=2)
+                        doc_preview = gr.Textbox(label="Document Preview", lines=4)
+                        doc_filter = gr.Dropdown(
+                            label="🗂️ Search In Documents",
+                            choices=[],
+                            multiselect=True,
+                            info="Leave empty to search the whole corpus"
+                        )
+                        remove_docs_btn = gr.Button("Remove Selected Documents")
 
-                    strategy_select = gr.Radio(
-                        label="📚 Prompting Strategy",
-                        choices=list(STRATEGIES.keys()),
-                        value="combined",
-                        info="Select the prompting approach"
-                    )
+                        gr.Markdown("### 🎯 Configuration")
+                        role_select = gr.Dropdown(
+                            label="🎭 AI Role",
+                            choices=list(ROLES.keys()),
+                            value="Teacher"
+                        )
 
-                    with gr.Row():
-                        use_self_consistency = gr.Checkbox(
-                            label="🔄 Self-Consistency",
-                            value=False,
-                            info="Generate multiple responses"
+                        strategy_select = gr.Radio(
+                            label="📚 Prompting Strategy",
+                            choices=list(STRATEGIES.keys()),
+                            value="combined",
+                            info="Select the prompting approach"
                         )
-                        use_custom_examples = gr.Checkbox(
-                            label="📝 Use Custom Examples",
-                            value=False
+
+                        with gr.Row():
+                            use_self_consistency = gr.Checkbox(
+                                label="🔄 Self-Consistency",
+                                value=False,
+                                info="Generate multiple responses"
+                            )
+                            use_custom_examples = gr.Checkbox(
+                                label="📝 Use Custom Examples",
+                                value=False
+                            )
+                            compare_strategies = gr.Checkbox(
+                                label="🔍 Compare All Strategies",
+                                value=False
+                            )
+
+                        min_relevance = gr.Slider(
+                            label="📏 Min Relevance Score",
+                            minimum=0.0,
+                            maximum=1.0,
+                            step=0.05,
+                            value=RETRIEVAL_MIN_SCORE,
+                            info="Chunks scoring below this are left out of the prompt"
                         )
-                        compare_strategies = gr.Checkbox(
-                            label="🔍 Compare All Strategies",
-                            value=False
+
+                    with gr.Column(scale=2):
+                        query_input = gr.Textbox(
+                            label="❓ Your Question",
+                            placeholder="What would you like to know about the document?",
+                            lines=3
                         )
 
-                with gr.Column(scale=2):
-                    query_input = gr.Textbox(
-                        label="❓ Your Question",
-                        placeholder="What would you like to know about the document?",
-                        lines=3
-                    )
+                        analyze_btn = gr.Button("🚀 Analyze", variant="primary", size="lg")
 
-                    analyze_btn = gr.Button("🚀 Analyze", variant="primary", size="lg")
+                        with gr.Row():
+                            with gr.Column(scale=2):
+                                main_response = gr.Textbox(
+                                    label="💬 AI Response",
+                                    lines=15
+                                )
+                                strategy_details = gr.Markdown(label="📊 Details")
 
-                    with gr.Row():
-                        with gr.Column(scale=2):
-                            main_response = gr.Textbox(
-                                label="💬 AI Response",
-                                lines=15
-                            )
-                            strategy_details = gr.Markdown(label="📊 Details")
+                            with gr.Column(scale=1):
+                                confidence_plot = gr.Plot(label="Confidence")
 
-                        with gr.Column(scale=1):
-                            confidence_plot = gr.Plot(label="Confidence")
+            # Prompt Engineering Tab
+            with gr.Tab("🔧 Prompt Engineering"):
+                gr.Markdown("### 👁️ Prompt Preview & Editing")
 
-        # Prompt Engineering Tab
-        with gr.Tab("🔧 Prompt Engineering"):
-            gr.Markdown("### 👁️ Prompt Preview & Editing")
+                with gr.Row():
+                    preview_role = gr.Dropdown(
+                        label="Role",
+                        choices=list(ROLES.keys()),
+                        value="Teacher"
+                    )
+                    preview_strategy = gr.Dropdown(
+                        label="Strategy",
+                        choices=list(STRATEGIES.keys()),
+                        value="combined"
+                    )
+                    preview_use_examples = gr.Checkbox(label="Include Examples", value=True)
 
-            with gr.Row():
-                preview_role = gr.Dropdown(
-                    label="Role",
-                    choices=list(ROLES.keys()),
-                    value="Teacher"
+                preview_query = gr.Textbox(
+                    label="Query",
+                    placeholder="Enter a query to preview the prompt"
                 )
-                preview_strategy = gr.Dropdown(
-                    label="Strategy",
-                    choices=list(STRATEGIES.keys()),
-                    value="combined"
-                )
-                preview_use_examples = gr.Checkbox(label="Include Examples", value=True)
 
-            preview_query = gr.Textbox(
-                label="Query",
-                placeholder="Enter a query to preview the prompt"
-            )
+                preview_btn = gr.Button("Preview Prompt")
+                prompt_preview = gr.Markdown(label="Prompt Preview")
 
-            preview_btn = gr.Button("Preview Prompt")
-            prompt_preview = gr.Markdown(label="Prompt Preview")
+                gr.Markdown("### ✏️ Custom Prompt Editor")
+                edited_prompt = gr.Textbox(
+                    label="Edit Prompt",
+                    lines=10,
+                    placeholder="Paste or write your custom prompt here..."
+                )
 
-            gr.Markdown("### ✏️ Custom Prompt Editor")
-            edited_prompt = gr.Textbox(
-                label="Edit Prompt",
-                lines=10,
-                placeholder="Paste or write your custom prompt here..."
-            )
+                regenerate_btn = gr.Button("Generate from Custom Prompt")
 
-            regenerate_btn = gr.Button("Generate from Custom Prompt")
+                with gr.Row():
+                    custom_response = gr.Textbox(label="Response", lines=10)
+                    custom_confidence = gr.Plot(label="Confidence")
 
-            with gr.Row():
-                custom_response = gr.Textbox(label="Response", lines=10)
-                custom_confidence = gr.Plot(label="Confidence")
+            # Example Library Tab
+            with gr.Tab("📚 Example Library"):
+                gr.Markdown("### 📝 Add Custom Examples for Few-Shot Learning")
 
-        # Example Library Tab
-        with gr.Tab("📚 Example Library"):
-            gr.Markdown("### 📝 Add Custom Examples for Few-Shot Learning")
+                with gr.Row():
+                    example_role = gr.Dropdown(
+                        label="Role",
+                        choices=list(ROLES.keys()),
+                        value="Teacher"
+                    )
 
-            with gr.Row():
-                example_role = gr.Dropdown(
-                    label="Role",
-                    choices=list(ROLES.keys()),
-                    value="Teacher"
+                example_query = gr.Textbox(
+                    label="Example Query",
+                    placeholder="What is quantum computing?"
                 )
 
-            example_query = gr.Textbox(
-                label="Example Query",
-                placeholder="What is quantum computing?"
-            )
+                example_response = gr.Textbox(
+                    label="Example Response",
+                    lines=5,
+                    placeholder="Quantum computing is like having a magical coin..."
+                )
 
-            example_response = gr.Textbox(
-                label="Example Response",
-                lines=5,
-                placeholder="Quantum computing is like having a magical coin..."
-            )
+                add_example_btn = gr.Button("Add Example")
+                example_status = gr.Textbox(label="Status")
+
+                gr.Markdown("### 📖 Current Examples")
+                for role_name in ROLES.keys():
+                    with gr.Accordion(f"{ROLES[role_name].emoji} {role_name} Examples", open=False):
+                        examples_text = "\n\n".join([
+                            f"**Q**: {ex['query']}\n**A**: {ex['response']}"
+                            for ex in ROLES[role_name].few_shot_examples
+                        ])
+                        gr.Markdown(examples_text or "No examples yet.")
+
+        # Event handlers
+        demo.load(fn=model_status_message, outputs=[model_status])
+        if hasattr(gr, "Timer"):
+            gr.Timer(2).tick(fn=model_status_message, outputs=[model_status])
+        else:
+            demo.load(fn=model_status_message, outputs=[model_status], every=2)
 
-            add_example_btn = gr.Button("Add Example")
-            example_status = gr.Textbox(label="Status")
-
-            gr.Markdown("### 📖 Current Examples")
-            for role_name in ROLES.keys():
-                with gr.Accordion(f"{ROLES[role_name].emoji} {role_name} Examples", open=False):
-                    examples_text = "\n\n".join([
-                        f"**Q**: {ex['query']}\n**A**: {ex['response']}"
-                        for ex in ROLES[role_name].few_shot_examples
-                    ])
-                    gr.Markdown(examples_text or "No examples yet.")
-
-    # Event handlers
-    process_btn.click(
-        fn=process_document,
-        inputs=[file_input],
-        outputs=[doc_status, doc_preview]
-    )
+        process_btn.click(
+            fn=process_document,
+            inputs=[file_input],
+            outputs=[doc_status, doc_preview, doc_filter]
+        )
 
-    analyze_btn.click(
-        fn=run_analysis,
-        inputs=[
-            file_input, role_select, query_input, strategy_select,
-            use_self_consistency, use_custom_examples, compare_strategies
-        ],
-        outputs=[main_response, strategy_details, confidence_plot]
-    )
+        remove_docs_btn.click(
+            fn=remove_documents,
+            inputs=[doc_filter],
+            outputs=[doc_status, doc_filter]
+        )
 
-    preview_btn.click(
-        fn=preview_prompt,
-        inputs=[preview_role, preview_query, preview_strategy, preview_use_examples],
-        outputs=[prompt_preview]
-    )
+        analyze_btn.click(
+            fn=run_analysis,
+            inputs=[
+                file_input, role_select, query_input, strategy_select,
+                use_self_consistency, use_custom_examples, compare_strategies,
+                doc_filter, min_relevance
+            ],
+            outputs=[main_response, strategy_details, confidence_plot],
+            concurrency_limit=GENERATION_MAX_BATCH_SIZE  # Let concurrent clicks reach the scheduler together
+        )
 
-    regenerate_btn.click(
-        fn=edit_and_regenerate,
-        inputs=[edited_prompt],
-        outputs=[custom_response, custom_confidence]
-    )
+        preview_btn.click(
+            fn=preview_prompt,
+            inputs=[preview_role, preview_query, preview_strategy, preview_use_examples],
+            outputs=[prompt_preview]
+        )
 
-    add_example_btn.click(
-        fn=add_custom_example,
-        inputs=[example_role, example_query, example_response],
-        outputs=[example_status]
-    )
+        regenerate_btn.click(
+            fn=edit_and_regenerate,
+            inputs=[edited_prompt],
+            outputs=[custom_response, custom_confidence],
+            concurrency_limit=GENERATION_MAX_BATCH_SIZE
+        )
 
-    # Footer
-    gr.Markdown(
-        """
-        ---
-        ### 🛠️ Technical Details
-        - **Strategies**: Standard, Few-Shot, Chain-of-Thought, Combined
-        - **Models**: {emb} (embeddings), {llm} (generation)
-        - **Enhancement**: Multi-strategy prompting with interactive features
-        """.format(emb=EMBEDDING_MODEL_NAME, llm=LLM_MODEL_NAME)
-    )
+        add_example_btn.click(
+            fn=add_custom_example,
+            inputs=[example_role, example_query, example_response],
+            outputs=[example_status]
+        )
+
+        # Footer
+        gr.Markdown(
+            """
+            ---
+            ### 🛠️ Technical Details
+            - **Strategies**: Standard, Few-Shot, Chain-of-Thought, Combined
+            - **Models**: {emb} (embeddings), {llm} (generation)
+            - **Enhancement**: Multi-strategy prompting with interactive features
+            """.format(emb=EMBEDDING_MODEL_NAME, llm=LLM_MODEL_NAME)
+        )
 
-print("Launching Ultra-Smart-AI Interface...")
-demo.launch(debug=False, share=True)
\ No newline at end of file
+    return demo
+
+def main():
+    """Starts the caches, health probes and model loading, then launches the UI."""
+    global response_cache
+    if "--profile-startup" in sys.argv:
+        profile_startup()
+        return
+    if RESPONSE_CACHE_SIZE:
+        response_cache = ResponseCache()
+    if HEALTH_PORT:
+        start_health_server()
+    start_model_loading()
+    demo = build_demo()
+    print("Launching Ultra-Smart-AI Interface...")
+    demo.launch(debug=False, share=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+"""PDF page extraction for worker processes.
+
+Kept separate from app.py so spawned workers only import pypdf, not
+Gradio and the rest of the app.
+"""
+
+from pypdf import PdfReader
+
+
+def extract_page_range(shard):
+    """Extracts (page_number, text) pairs for one shard of pages (runs in a worker process)."""
+    file_path, start, stop = shard
+    reader = PdfReader(file_path)
+    pages = []
+    for page_number in range(start, stop):
+        page_text = reader.pages[page_number].extract_text()
+        if page_text:
+            pages.append((page_number, page_text))
+    return pages